@@ -14,7 +14,7 @@ os.system("mkdir -p /data/tmp/{0}/condor_submit_logs/chronosim/".format(username
 
 fout.write("""
 universe=Vanilla
-when_to_transfer_output = ON_EXIT
+when_to_transfer_output = ON_EXIT_OR_EVICT
 transfer_input_files=wrapper.sh, package.tar.xz
 +DESIRED_Sites="T2_US_UCSD"
 +remote_DESIRED_Sites="T2_US_UCSD"
@@ -33,7 +33,10 @@ for f in files[::2]:
     jobid = (f.split("_")[-1]).split(".")[0]
     fout.write("executable=wrapper.sh\n")
     fout.write("transfer_executable=True\n")
-    fout.write("arguments={0} {1} {2} {3}\n".format(jobid, tag, stlTag, outdir))
+    # Checkpoints are spooled on eviction and restored when the job restarts
+    ckptDir = "ckpt_{0}".format(jobid)
+    fout.write("transfer_output_files={0}\n".format(ckptDir))
+    fout.write("arguments={0} {1} {2} {3} {4}\n".format(jobid, tag, stlTag, outdir, ckptDir))
     fout.write("queue\n\n")
 
 
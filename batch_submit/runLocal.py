@@ -0,0 +1,103 @@
+import os, errno, subprocess, sys, time, multiprocessing
+from multiprocessing.pool import ThreadPool
+
+# Local equivalents of the paths used by wrapper.sh, overridden by the
+# environment variables of the same name
+inputDir = os.environ.get("CHRONOSIM_INPUT_DIR", "/hadoop/cms/store/user/bemarsh/LGAD/traj_inputs_for_jonathan")
+stlBase = os.environ.get("CHRONOSIM_STL_BASE", "/nfs-7/userdata/jguiang/chronosim/stl")
+# If set, write the outputs of each config's outdir to {outBase}/{basename of outdir}
+outBase = os.environ.get("CHRONOSIM_OUT_BASE")
+packageDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def ReadJobs(configPath):
+    """ Read (file id, tag, STL tag, outdir) of each job from a condor config
+        made by makeConfigs.py, or from a txt file with one job per line
+    """
+    jobs = []
+    with open(configPath, "r") as fin:
+        for line in fin:
+            line = line.strip()
+            if line.startswith("arguments="):
+                line = line[len("arguments="):]
+            elif "=" in line or line.startswith("#"):
+                continue
+            args = line.split()
+            # Configs may also pass a checkpoint directory, local jobs
+            # checkpoint next to their output instead
+            if len(args) in (4, 5):
+                jobs.append(tuple(args[:4]))
+
+    return jobs
+
+def GetPaths(job):
+    """ Return STL directory, input ray file and output file of a job """
+    fileID, tag, stlTag, outdir = job
+    if outBase is not None:
+        outdir = os.path.join(outBase, os.path.basename(os.path.normpath(outdir)))
+    stlDir = "{0}/{1}".format(stlBase, stlTag)
+    inFile = "{0}/{1}/output_{2}.txt".format(inputDir, tag, fileID)
+    outFile = "{0}/output_{1}.root".format(outdir, fileID)
+    return stlDir, inFile, outFile
+
+def GetSize(job):
+    """ Return size of the input ray file of a job (0 if missing) """
+    inFile = GetPaths(job)[1]
+    return os.path.getsize(inFile) if os.path.isfile(inFile) else 0
+
+def RunJob(job, nRetries=2):
+    """ Run one job as a chronosim.py process, retrying failed attempts, and
+        return (job, return code, attempts, seconds)
+    """
+    stlDir, inFile, outFile = GetPaths(job)
+    outdir = os.path.dirname(outFile)
+    if not os.path.isdir(outdir):
+        try:
+            os.makedirs(outdir)
+        except OSError as error:
+            # Another job may have created it in the meantime
+            if error.errno != errno.EEXIST: raise
+    start = time.time()
+    for attempt in range(1, nRetries+2):
+        logPath = "{0}.log".format(os.path.splitext(outFile)[0])
+        with open(logPath, "a") as log:
+            log.write("[runLocal] attempt {0}: {1} {2} {3}\n".format(attempt, stlDir, inFile, outFile))
+            log.flush()
+            # chronosim.py checkpoints, so a retry resumes where the last attempt stopped
+            code = subprocess.call([sys.executable, "chronosim.py", stlDir, inFile, outFile],
+                                   cwd=packageDir, stdout=log, stderr=subprocess.STDOUT)
+        if code == 0: break
+
+    return job, code, attempt, time.time()-start
+
+def RunJobs(jobs, nJobs=None, nRetries=2):
+    """ Run jobs on local cores, at most nJobs at once, largest input first """
+    jobs = sorted(jobs, key=GetSize, reverse=True)
+    nJobs = nJobs or multiprocessing.cpu_count()
+    pool = ThreadPool(nJobs)
+    failed = []
+    start = time.time()
+    try:
+        results = pool.imap_unordered(lambda job: RunJob(job, nRetries=nRetries), jobs)
+        for i, (job, code, attempts, seconds) in enumerate(results):
+            if code != 0: failed.append(job)
+            print("[runLocal] {0}/{1} done ({2} failed, {3:.0f}s elapsed): output_{4} {5} after {6} attempt(s) in {7:.0f}s".format(
+                  i+1, len(jobs), len(failed), time.time()-start, job[0],
+                  "ok" if code == 0 else "FAILED", attempts, seconds))
+    finally:
+        pool.close()
+        pool.join()
+
+    print("[runLocal] {0} of {1} jobs succeeded in {2:.0f}s".format(len(jobs)-len(failed), len(jobs), time.time()-start))
+    for job in failed:
+        print("[runLocal] failed: {}".format(" ".join(job)))
+
+    return failed
+
+if __name__ == "__main__":
+    # Usage: python runLocal.py configs/config_{tag}_{stlTag}.cmd [nJobs] [nRetries]
+    # with paths overridden by CHRONOSIM_INPUT_DIR, CHRONOSIM_STL_BASE and CHRONOSIM_OUT_BASE
+    configPath = sys.argv[1]
+    nJobs = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    nRetries = int(sys.argv[3]) if len(sys.argv) > 3 else 2
+    failed = RunJobs(ReadJobs(configPath), nJobs=nJobs, nRetries=nRetries)
+    sys.exit(1 if failed else 0)
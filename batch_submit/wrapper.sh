@@ -8,11 +8,13 @@ FILEID=$1
 TAG=$2
 STLTAG=$3
 COPYDIR=$4
+CKPTDIR=$5
 
 return
 
 echo "[wrapper] FILEID    = " ${FILEID}
 echo "[wrapper] COPYDIR   = " ${COPYDIR}
+echo "[wrapper] CKPTDIR   = " ${CKPTDIR}
 
 #
 # set up environment
@@ -56,9 +58,13 @@ ls -a
 # run it
 #
 INFILE="/hadoop/cms/store/user/bemarsh/LGAD/traj_inputs_for_jonathan/${TAG}/output_${FILEID}.txt"
-echo "[wrapper] running: python chronosim.py" "/nfs-7/userdata/jguiang/chronosim/stl/${STLTAG}" $INFILE "output.root" 
+echo "[wrapper] running: python chronosim.py" "/nfs-7/userdata/jguiang/chronosim/stl/${STLTAG}" $INFILE "output.root" ${CKPTDIR}
 
-python chronosim.py nfs-7/userdata/jguiang/chronosim/stl/${STLTAG} $INFILE output.root
+# Checkpoints of an evicted run are transferred back into the sandbox
+if [ -d "${CKPTDIR}" ]; then
+    echo "[wrapper] resuming from checkpoint " ${CKPTDIR}
+fi
+python chronosim.py nfs-7/userdata/jguiang/chronosim/stl/${STLTAG} $INFILE output.root ${CKPTDIR}
 
 #
 # do something with output
@@ -85,7 +91,9 @@ export LD_PRELOAD=/usr/lib64/gfal2-plugins/libgfal_plugin_xrootd.so
 gfal-copy -p -f -t 4200 --verbose file://`pwd`/${OUTPUT} gsiftp://gftp.t2.ucsd.edu${COPYDIR}/output_${FILEID}.root
 
 echo "[wrapper] cleaning up"
-for FILE in `find . -not -name "*stderr" -not -name "*stdout"`; do rm -rf $FILE; done
+for FILE in `find . -not -name "*stderr" -not -name "*stdout" -not -path "./${CKPTDIR}*"`; do rm -rf $FILE; done
+# Condor transfers the checkpoint directory on exit too, so it must exist
+mkdir -p ${CKPTDIR}
 echo "[wrapper] cleaned up"
 pwd
 ls
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import os
+import shutil
+import tempfile
+import time
+from stl import mesh
+import etlsim
+import btlsim
+from chronosim import ENGINES, IterHits, HitTest
+from outtree import OutTree
+from rays import RAY_DTYPE, LoadRays
+
+def WriteSTL(path, triangles):
+    """ Write (n, 3, 3) array of triangles to a binary STL file """
+    lgadMesh = mesh.Mesh(np.zeros(len(triangles), dtype=mesh.Mesh.dtype))
+    lgadMesh.vectors[:] = triangles
+    lgadMesh.update_normals()
+    lgadMesh.save(path)
+    return
+
+def MakeSquares(centers, pitch, z, fill=0.9):
+    """ Return (2n, 3, 3) triangles of squares facing +z at each xy-center """
+    half = 0.5*fill*pitch
+    x, y = centers[:, 0], centers[:, 1]
+    zs = np.full(len(centers), z)
+    a = np.stack((x-half, y-half, zs), axis=1)
+    b = np.stack((x+half, y-half, zs), axis=1)
+    c = np.stack((x+half, y+half, zs), axis=1)
+    d = np.stack((x-half, y+half, zs), axis=1)
+    return np.concatenate((np.stack((a, b, c), axis=1), np.stack((c, d, a), axis=1)))
+
+def MakeDisks(nFacets, nLayers=4, innerRad=315., outerRad=1270., z0=3000., dz=10.):
+    """ Return triangles (mm) of nLayers ETL-like disks of about nFacets
+        facets each, tiled with square LGADs offset from layer to layer
+    """
+    pitch = (np.pi*(outerRad**2-innerRad**2)/(nFacets/2.))**0.5
+    disks = []
+    for j in range(nLayers):
+        offset = 0.5*pitch*(j % 2)
+        ticks = np.arange(-outerRad, outerRad+pitch, pitch)+offset
+        x, y = np.meshgrid(ticks, ticks)
+        centers = np.stack((x.reshape(-1), y.reshape(-1)), axis=1)
+        r = np.hypot(centers[:, 0], centers[:, 1])
+        centers = centers[(r > innerRad) & (r < outerRad)]
+        disks.append(MakeSquares(centers, pitch, z0+j*dz))
+
+    return disks
+
+def MakeCylinder(nFacets, rad=1168.5, length=5000.):
+    """ Return triangles (mm) of a BTL-like cylinder of about nFacets facets
+        with outward normals
+    """
+    nPhi = max(3, int((nFacets/2.*2*np.pi*rad/length)**0.5))
+    nZ = max(1, nFacets//(2*nPhi))
+    phi = np.linspace(0, 2*np.pi, nPhi+1)
+    z = np.linspace(-length/2., length/2., nZ+1)
+    phi1, z1 = [ array.reshape(-1) for array in np.meshgrid(phi[:-1], z[:-1]) ]
+    phi2, z2 = [ array.reshape(-1) for array in np.meshgrid(phi[1:], z[1:]) ]
+    Point = lambda p, h: np.stack((rad*np.cos(p), rad*np.sin(p), h), axis=1)
+    return np.concatenate((np.stack((Point(phi1, z1), Point(phi2, z1), Point(phi2, z2)), axis=1),
+                           np.stack((Point(phi1, z1), Point(phi2, z2), Point(phi1, z2)), axis=1)))
+
+def MakeRays(nRays, kind="etl", seed=0):
+    """ Return structured array of muons from the origin, positioned at the
+        first ETL disk (z = 3 m) or on the BTL cylinder (r = 1.1685 m)
+    """
+    rng = np.random.RandomState(seed)
+    rays = np.zeros(nRays, dtype=RAY_DTYPE)
+    rays["id"] = 13
+    rays["mass"] = 0.105658
+    rays["charge"] = rng.choice([-1., 1.], nRays)
+    rays["pt"] = rng.uniform(0.5, 5., nRays)
+    rays["eta"] = rng.uniform(1.5, 3.1, nRays) if kind == "etl" else rng.uniform(-1.5, 1.5, nRays)
+    rays["phi"] = rng.uniform(-np.pi, np.pi, nRays)
+    direction = np.stack((np.cos(rays["phi"]), np.sin(rays["phi"]), np.sinh(rays["eta"])), axis=1)
+    rays["p"] = rays["pt"][:, np.newaxis]*direction
+    # Scale direction to reach z = 3 m or r = 1.1685 m
+    rays["pos"] = direction*(3./direction[:, 2:] if kind == "etl" else 1.1685)
+    return rays
+
+def WriteRays(path, rays):
+    """ Write rays to a txt file in the 12-column LoadRays format """
+    np.savetxt(path, np.ascontiguousarray(rays).view(np.float64).reshape(-1, 12))
+    return
+
+def Timed(timings, stage, nRays, nFacets, func, *args, **kwargs):
+    """ Call func, record its wall time in timings, return its result """
+    start = time.time()
+    result = func(*args, **kwargs)
+    timings.append((stage, time.time()-start, nRays, nFacets))
+    return result
+
+def RunHits(geometry, rays, **options):
+    """ Hit test every ray, return list of IterHits results """
+    return list(IterHits(geometry, rays, **options))
+
+def WriteTree(geometry, hits, outPath):
+    """ Fill and write OutTree from a list of IterHits results """
+    # Only load ROOT when writing, so that CheckEngines runs without it
+    import ROOT
+    outFile = ROOT.TFile(outPath, "RECREATE")
+    rayOut = OutTree(nLayers=len(geometry))
+    for block, nHits, layerHits, layerHitPos in hits:
+        rayOut.FillBlock(block, nHits, layerHits, layerHitPos)
+    rayOut.tree.Write()
+    outFile.Close()
+    return
+
+def CheckEngines(geometry, rays, propagation=None):
+    """ Return names of engines whose hits differ from the CheckHit reference """
+    reference = HitTest(geometry, rays, engine="loop", propagation=propagation)
+    bad = []
+    for engine in sorted(ENGINES):
+        result = HitTest(geometry, rays, engine=engine, propagation=propagation)
+        if not all(np.array_equal(a, b) for a, b in zip(reference, result)):
+            bad.append(engine)
+    return bad
+
+def Benchmark(kind="etl", nFacets=20000, nRays=100000, nWorkers=1, maxDensePairs=2*10**7,
+              nCheckFacets=200, nCheckRays=200, workDir=None, verbose=True):
+    """ Time each stage of a simulation of nRays synthetic rays through a
+        synthetic ETL ("etl") or BTL ("btl") geometry of about nFacets facets
+        per layer, and check every engine against CheckHit on a smaller
+        geometry. Return list of (stage, seconds, nRays, nFacets).
+    """
+    isTemp = (workDir is None)
+    workDir = tempfile.mkdtemp(prefix="chronobench_") if isTemp else workDir
+    stlDir = os.path.join(workDir, kind)
+    rayPath = os.path.join(workDir, "rays_{}.txt".format(kind))
+    outPath = os.path.join(workDir, "output_{}.root".format(kind))
+    sim = etlsim if kind == "etl" else btlsim
+    # BTL cut on facet area would reject the small facets of a fine mesh
+    meshOptions = {} if kind == "etl" else {"aCut": 0}
+    if not os.path.isdir(stlDir): os.makedirs(stlDir)
+    layers = MakeDisks(nFacets) if kind == "etl" else [MakeCylinder(nFacets)]
+    for j, layer in enumerate(layers):
+        WriteSTL(os.path.join(stlDir, "layer{}.stl".format(j)), layer)
+    WriteRays(rayPath, MakeRays(nRays, kind))
+
+    timings = []
+    geometry = Timed(timings, "mesh load", 0, 0, sim.LoadMesh, stlDir, sf=0.001, **meshOptions)
+    nTotal = len(geometry.vertices)
+    rays = Timed(timings, "ray load", nRays, 0, LoadRays, rayPath)
+    for engine in ["grid", "batch"]:
+        if engine == "batch" and nRays*nTotal > maxDensePairs: continue
+        hits = Timed(timings, "hit test ({})".format(engine), nRays, nTotal,
+                     RunHits, geometry, rays, engine=engine, nWorkers=nWorkers)
+    Timed(timings, "OutTree write", nRays, 0, WriteTree, geometry, hits, outPath)
+    if kind == "etl":
+        from plot import Plot
+        Timed(timings, "ChronoPlots", nRays, 0, Plot, outPath, os.path.join(workDir, "plots"))
+
+    # Check engines against the reference CheckHit loop on a small geometry
+    checkDir = os.path.join(workDir, kind+"_check")
+    if not os.path.isdir(checkDir): os.makedirs(checkDir)
+    checkLayers = MakeDisks(nCheckFacets) if kind == "etl" else [MakeCylinder(nCheckFacets)]
+    for j, layer in enumerate(checkLayers):
+        WriteSTL(os.path.join(checkDir, "layer{}.stl".format(j)), layer)
+    checkGeometry = sim.LoadMesh(checkDir, sf=0.001, **meshOptions)
+    checkRays = MakeRays(nCheckRays, kind, seed=1)
+    bad = CheckEngines(checkGeometry, checkRays)
+    if kind == "etl":
+        bad += [ engine+" (straight)" for engine in CheckEngines(checkGeometry, checkRays, "straight") ]
+
+    if verbose:
+        print("---------------- {} ----------------".format(kind.upper()))
+        print("{0:<18} {1:>10} {2:>12} {3:>16}".format("stage", "seconds", "rays/s", "facets*rays/s"))
+        for stage, seconds, n, facets in timings:
+            rate = n/seconds if n and seconds > 0 else float("nan")
+            facetRate = n*facets/seconds if n and facets and seconds > 0 else float("nan")
+            print("{0:<18} {1:>10.3f} {2:>12.4g} {3:>16.4g}".format(stage, seconds, rate, facetRate))
+        if bad:
+            print("FAILED: {} differ from CheckHit".format(", ".join(bad)))
+        else:
+            print("All engines ({}) agree with CheckHit".format(", ".join(sorted(ENGINES))))
+
+    if isTemp: shutil.rmtree(workDir)
+    if bad:
+        raise RuntimeError("Engines differ from CheckHit: {}".format(", ".join(bad)))
+
+    return timings
+
+if __name__ == "__main__":
+    import sys
+    import ROOT
+    # Usage: python benchmark.py [nFacets] [nRays] [nWorkers]
+    ROOT.gROOT.SetBatch(ROOT.kTRUE)
+    ROOT.gErrorIgnoreLevel = ROOT.kWarning
+    nFacets = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    nRays = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+    nWorkers = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    for kind in ["etl", "btl"]:
+        Benchmark(kind, nFacets=nFacets, nRays=nRays, nWorkers=nWorkers)
@@ -1,40 +1,122 @@
 import json
 import os
+import sys
+import numpy as np
+import multiprocessing
+from array import array
+from glob import glob
+
+# One row per LGAD position
+LOG_DTYPE = np.dtype([ ("layer", np.int32),
+                       ("quad",  np.int32),
+                       ("x",     np.float64),
+                       ("y",     np.float64),
+                       ("z",     np.float64) ])
+
+def LoadTable(inFile):
+    """ Load (memory-mapped) table written by Output.Write """
+    return np.load(inFile, mmap_mode="r")
+
+def ToDict(table, layerZ=None):
+    """ Return nested {layer: {"z": z, quad: {x: [y, ...]}}} output of a table """
+    output = {}
+    for layer, z in (layerZ or {}).items():
+        output[layer] = {"z": z}
+    for layer, quad, x, y, z in table.tolist():
+        output.setdefault(layer, {"z": z})
+        output[layer].setdefault(quad, {}).setdefault(x, []).append(y)
+    return output
+
+def WriteTable(table, outFile, layerZ=None, verbose=False):
+    """ Write table to binary .npy file, or nested output to .json file """
+    if outFile.split(".")[-1] == "json":
+        with open(outFile, "w") as fout:
+            json.dump(ToDict(table, layerZ), fout, indent=4)
+    else:
+        np.save(outFile, table)
+    if verbose: print("Wrote output to {}".format(outFile))
+
+    return
+
+def FindLogs(inPath):
+    """ Return sorted log files in a directory, or matching a glob pattern """
+    if os.path.isdir(inPath):
+        inPath = os.path.join(inPath, "*_log*.txt")
+    return sorted(glob(inPath))
+
+def _ParseLog(args):
+    """ Parse a single log file into a table (for Pool.map) """
+    inFile, sf = args
+    out = Output(sf=sf)
+    out.ParseFile(inFile)
+    return out.Table()
+
+def ParseLogs(inPath, sf=0.001, nWorkers=None, verbose=False):
+    """ Parse every log file in a directory or glob across nWorkers processes,
+        and merge them into one table without duplicate rows
+    """
+    logFiles = FindLogs(inPath)
+    if verbose: print("Parsing {0} log files from {1}".format(len(logFiles), inPath))
+    pool = multiprocessing.Pool(nWorkers)
+    try:
+        tables = pool.map(_ParseLog, [ (logFile, sf) for logFile in logFiles ], chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    table = np.unique(np.concatenate([ np.zeros(0, dtype=LOG_DTYPE) ]+tables))
+    if verbose:
+        print("Merged {0} rows into {1} unique rows".format(sum(map(len, tables)), len(table)))
+
+    return table
 
 class Output:
-    def __init__(self, outFile="./out.json", sf=0.001, verbose=False):
+    def __init__(self, outFile="./out.npy", sf=0.001, verbose=False):
         self.outFile = outFile
-        self.output = {}
         self.didStart = False
         self.curLayer = 0
         self.curQuad = 0
+        self.curXPos = 0
+        self.layerZ = {}
         self.sf = sf
         self.verbose = verbose
+        # Columns of the output table
+        self.columns = dict((name, array("i" if LOG_DTYPE[name].kind == "i" else "d"))
+                            for name in LOG_DTYPE.names)
 
     def IsValidFile(self, inFile):
         """ Check for valid file """
         isLogFile = (inFile.split(".")[-1] == "txt" and "log" in inFile)
         return (os.path.isfile(inFile) and isLogFile)
-    
-    def Write(self):
-        with open(self.outFile, "w") as fout:
-            json.dump(self.output, fout, indent=4)
-            if self.verbose: print("Wrote output to {}".format(self.outFile))
 
+    def Table(self):
+        """ Return (layer, quad, x, y, z) table as a structured array """
+        table = np.zeros(len(self.columns["layer"]), dtype=LOG_DTYPE)
+        for name in LOG_DTYPE.names:
+            table[name] = np.frombuffer(self.columns[name], dtype=table[name].dtype)
+        return table
+
+    def ToDict(self):
+        """ Return nested {layer: {"z": z, quad: {x: [y, ...]}}} output """
+        return ToDict(self.Table(), self.layerZ)
+
+    def Write(self):
+        """ Write table to binary .npy file, or nested output to .json file """
+        WriteTable(self.Table(), self.outFile, self.layerZ, self.verbose)
         return
 
     def HandleLGAD(self, lgad):
         """ Handle output for a strip of LGADs """
         if not self.didStart: return
-        curXPos = 0
         for out in lgad:
             param = out.split(" = ")
             if param[0] == "x":
-                curXPos = float(param[1])*self.sf
-                if curXPos not in self.output[self.curLayer][self.curQuad]:
-                    self.output[self.curLayer][self.curQuad][curXPos] = []
+                self.curXPos = float(param[1])*self.sf
             elif param[0] == "y":
-                self.output[self.curLayer][self.curQuad][curXPos].append(float(param[1])*self.sf)
+                self.columns["layer"].append(self.curLayer)
+                self.columns["quad"].append(self.curQuad)
+                self.columns["x"].append(self.curXPos)
+                self.columns["y"].append(float(param[1])*self.sf)
+                self.columns["z"].append(self.layerZ[self.curLayer])
 
         return
 
@@ -45,8 +127,6 @@ class Output:
             param = out.split(" = ")
             if param[0] == "nQuad":
                 self.curQuad = int(param[1])
-                if self.curQuad not in self.output[self.curLayer]:
-                    self.output[self.curLayer][self.curQuad] = {}
 
         return
 
@@ -56,23 +136,21 @@ class Output:
             param = out.split(" = ")
             if param[0] == "layer":
                 self.curLayer = int(param[1])
-                if self.curLayer not in self.output:
-                    self.output[self.curLayer] = {}
-            if param[0] == "z" and param[0] not in self.output[self.curLayer]:
-                self.output[self.curLayer]["z"] = float(param[1])*self.sf
-        
+                self.layerZ.setdefault(self.curLayer, float("nan"))
+            if param[0] == "z" and np.isnan(self.layerZ[self.curLayer]):
+                self.layerZ[self.curLayer] = float(param[1])*self.sf
+
         self.didStart = True
         return
 
     def ParseFile(self, inFile):
-        """ Parse valid log file """
+        """ Parse valid log file line by line """
         if not self.IsValidFile(inFile):
             print("ERROR: Invalid file type / File does not exist")
             return
         if self.verbose: print("Parsing file {}".format(inFile))
         with open(inFile, "r") as fin:
-            allLines = fin.readlines()
-            for line in allLines:
+            for line in fin:
                 splitLine = (line.split("\n")[0]).split(", ")
                 if "START" in splitLine[0]:
                     self.HandleStart(splitLine[1:])
@@ -83,8 +161,12 @@ class Output:
         return
 
 if __name__ == "__main__":
-    out = Output(verbose=True)
-    out.ParseFile("txt/dMod-3x2_315mmInnerRad_log0.txt")
-    out.Write()
-
-
+    # Usage: python chronolog.py [log file, directory or "glob"] [output file]
+    inPath = sys.argv[1] if len(sys.argv) > 1 else "txt/dMod-3x2_315mmInnerRad_log0.txt"
+    outFile = sys.argv[2] if len(sys.argv) > 2 else "./out.npy"
+    if os.path.isfile(inPath):
+        out = Output(outFile, verbose=True)
+        out.ParseFile(inPath)
+        out.Write()
+    else:
+        WriteTable(ParseLogs(inPath, verbose=True), outFile, verbose=True)
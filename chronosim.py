@@ -1,9 +1,17 @@
 # -*- coding: utf-8 -*-
 import numpy as np
-from stl import mesh
-from outtree import OutTree
-import ROOT
+from outtree import OutTree, NpzTree, AppendArrays
+from rays import IterBlocks
+from propagate import Propagate
+from instrument import Stage, TimeIter
+from efficiency import EffAccumulator
+from itertools import islice
 import os
+import json
+import shutil
+import hashlib
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
 
 def DotProduct(a, b):
     """ Return a·b """
@@ -57,59 +65,437 @@ def CheckHit(poly, hitPos, norm):
 
     return (cross0[2] > 0 and cross1[2] > 0 and cross2[2] > 0)
 
-def Parse(layers, norms, rays, outPath, verbose=False):
-    """ Parse polygons and rays, look for hits """
-    # Setup output file
-    outFile = ROOT.TFile(outPath, "RECREATE")
-    rayOut = OutTree()
-    # Loop over rays
-    for i, ray in enumerate(rays):
-        # Initialize output tree
-        rayOut.GetKinematics(ray)
-        nHits = 0
-        layerHits = [ False for l in layers ]
-        layerHitPosX = [ 0 for l in layers ]
-        layerHitPosY = [ 0 for l in layers ]
-        layerHitPosZ = [ 0 for l in layers ]
-        # Get (potential) hit position
-        hitPos = ray["pos"]
-        # Loop over layers
+def GetTransforms(norms):
+    """ Vectorized GetTransform, return (n, 3, 3) stack of matrices R
+        for an (n, 3) array of normalized facet normal vectors
+    """
+    norms = np.asarray(norms, dtype=float).reshape(-1, 3)
+    # New basis vectors in original coordinates
+    e3 = norms
+    e2 = np.zeros_like(norms)
+    isFlat = (norms[:, 2] == 0)
+    e2[~isFlat, 1] = 1
+    e2[isFlat, 2] = 1
+    e1 = np.cross(e2, e3)
+
+    return np.stack((e1, e2, e3), axis=1)
+
+def CheckHits(hitPos, normals, frames, edges, edgeConsts):
+    """ Batched CheckHit, return (nRays, nPolys) boolean array of hits for an
+        (nRays, 3) array of hit positions against polygons with precomputed
+        projection frames, projected edge vectors and edge constants
+    """
+    # Hit pos in rotated basis of each polygon, translated to polygon plane
+    hitPosTransf = np.einsum("fij,nj->nfi", frames[:, :2], hitPos)
+    # z-components of cross products (vertex - hit pos) x edge
+    cross = (edgeConsts[np.newaxis]
+             - hitPosTransf[:, :, np.newaxis, 0]*edges[np.newaxis, :, :, 1]
+             + hitPosTransf[:, :, np.newaxis, 1]*edges[np.newaxis, :, :, 0])
+    # Hit pos must also be on the same side as the normal
+    return np.all(cross > 0, axis=2) & (np.dot(hitPos, normals.T) >= 0)
+
+def GetLayerPos(hitPos, nLayers):
+    """ Return (nRays, nLayers, 3) hit positions from an (nRays, 3) array of
+        positions shared by all layers or an (nRays, nLayers, 3) array
+    """
+    hitPos = np.asarray(hitPos, dtype=float)
+    if hitPos.ndim == 3:
+        return hitPos
+    return np.broadcast_to(hitPos.reshape(-1, 1, 3), (len(hitPos), nLayers, 3))
+
+def LoopHitTest(geometry, hitPos, nTests=None):
+    """ Reference hit test, call CheckHit once per ray, layer and polygon.
+        Add the number of CheckHit calls of each ray to nTests if given.
+    """
+    layers, norms = geometry.layers, geometry.norms
+    layerPos = GetLayerPos(hitPos, len(layers))
+    nHits = np.zeros(len(hitPos), dtype=int)
+    layerHits = np.zeros((len(hitPos), len(layers)), dtype=bool)
+    layerHitPos = np.zeros((len(hitPos), len(layers), 3))
+    for i in range(len(hitPos)):
         for j, layer in enumerate(layers):
-            # Save first position for all particles for efficiency calculation
-            if j == 0:
-                rayOut.x = hitPos[0]
-                rayOut.y = hitPos[1]
-                rayOut.z = hitPos[2]
-            # Loop over polygons
+            pos = layerPos[i][j]
             for k, poly in enumerate(layer):
-                # Check for proximity then trajectory intersection
-                if CheckHit(poly, hitPos, norms[j][k]):
-                    nHits += 1
-                    layerHits[j] = True
-                    layerHitPosX[j] = hitPos[0]
-                    layerHitPosY[j] = hitPos[1]
-                    layerHitPosZ[j] = hitPos[2]
-
-        # Set remaining branches
-        rayOut.nHits = nHits
-        rayOut.layerHits = np.array(layerHits)
-        rayOut.layerHitPosX = np.array(layerHitPosX)
-        rayOut.layerHitPosY = np.array(layerHitPosY)
-        rayOut.layerHitPosZ = np.array(layerHitPosZ)
+                if CheckHit(poly, pos, norms[j][k]):
+                    nHits[i] += 1
+                    layerHits[i][j] = True
+                    layerHitPos[i][j] = pos
+    if nTests is not None:
+        nTests += len(geometry.vertices)
+
+    return nHits, layerHits, layerHitPos
+
+def BatchHitTest(geometry, hitPos, maxPairs=2**20, nTests=None):
+    """ Hit test blocks of rays against every polygon in a layer at once """
+    nLayers = len(geometry)
+    layerPos = GetLayerPos(hitPos, nLayers)
+    nHits = np.zeros(len(hitPos), dtype=int)
+    layerHits = np.zeros((len(hitPos), nLayers), dtype=bool)
+    layerHitPos = np.zeros((len(hitPos), nLayers, 3))
+    for j in range(nLayers):
+        facets = geometry.Slice(j)
+        nFacets = facets.stop-facets.start
+        if nFacets == 0: continue
+        # Limit number of (ray, polygon) pairs held in memory at once
+        blockSize = max(1, maxPairs//nFacets)
+        for start in range(0, len(hitPos), blockSize):
+            stop = start+blockSize
+            hits = CheckHits(layerPos[start:stop, j], geometry.normals[facets], 
+                             geometry.frames[facets], geometry.edges[facets],
+                             geometry.edgeConsts[facets])
+            nHits[start:stop] += np.count_nonzero(hits, axis=1)
+            layerHits[start:stop, j] = np.any(hits, axis=1)
+    if nTests is not None:
+        nTests += len(geometry.vertices)
+
+    layerHitPos[layerHits] = layerPos[layerHits]
+
+    return nHits, layerHits, layerHitPos
+
+def GridHitTest(geometry, hitPos, nTests=None):
+    """ Hit test rays only against nearby polygons found with each layer's
+        grids, querying routed grids only with the rays that may hit them
+    """
+    nLayers = len(geometry)
+    layerPos = GetLayerPos(hitPos, nLayers)
+    nHits = np.zeros(len(hitPos), dtype=int)
+    layerHits = np.zeros((len(hitPos), nLayers), dtype=bool)
+    layerHitPos = np.zeros((len(hitPos), nLayers, 3))
+    for j in range(nLayers):
+        # Rays that may hit each grid, None for every ray
+        rayLists = geometry.routers[j].Route(layerPos[:, j])
+        for grid, index in zip(geometry.grids[j], rayLists):
+            # Look up candidate (ray, polygon) pairs
+            if index is None:
+                rays, facets = grid.Query(layerPos[:, j])
+            else:
+                rays, facets = grid.Query(layerPos[index, j])
+                rays = index[rays]
+            if len(rays) == 0: continue
+            if nTests is not None:
+                nTests += np.bincount(rays, minlength=len(hitPos))
+            # Exact test of each candidate pair
+            pos = layerPos[rays, j]
+            hitPosTransf = np.einsum("kij,kj->ki", geometry.frames[facets, :2], pos)
+            edges = geometry.edges[facets]
+            cross = (geometry.edgeConsts[facets]
+                     - hitPosTransf[:, np.newaxis, 0]*edges[..., 1]
+                     + hitPosTransf[:, np.newaxis, 1]*edges[..., 0])
+            hits = np.all(cross > 0, axis=1) & (np.einsum("kj,kj->k", pos, geometry.normals[facets]) >= 0)
+            counts = np.bincount(rays[hits], minlength=len(hitPos))
+            nHits += counts
+            layerHits[:, j] |= (counts > 0)
+
+    layerHitPos[layerHits] = layerPos[layerHits]
+
+    return nHits, layerHits, layerHitPos
+
+ENGINES = {"loop": LoopHitTest, "batch": BatchHitTest, "grid": GridHitTest}
+
+def ShareArrays(arrays):
+    """ Copy dict of arrays into shared memory, return dict of
+        (buffer, dtype, shape) that can be passed to worker processes
+    """
+    shared = {}
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        buf = RawArray("B", max(array.nbytes, 1))
+        np.frombuffer(buf, dtype=array.dtype, count=array.size)[:] = array.reshape(-1)
+        shared[name] = (buf, array.dtype.str, array.shape)
+
+    return shared
+
+def UnshareArrays(shared):
+    """ Return read-only array views of shared memory made with ShareArrays """
+    arrays = {}
+    for name, (buf, dtype, shape) in shared.items():
+        array = np.frombuffer(buf, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+        array.flags.writeable = False
+        arrays[name] = array
+
+    return arrays
+
+def GetHitPos(geometry, block, propagation=None, bField=3.8):
+    """ Return (nRays, 3) hit positions shared by every layer, or (nRays,
+        nLayers, 3) positions on each layer's z-plane if propagation is set
+    """
+    if propagation is None:
+        # Use the same (potential) hit position for every layer
+        return np.asarray(block["pos"], dtype=float).reshape(-1, 3)
+    elif propagation == "straight":
+        return Propagate(block, geometry.layerZ)
+    elif propagation == "helix":
+        return Propagate(block, geometry.layerZ, bField=bField)
+    raise ValueError("Unknown propagation: {}".format(propagation))
+
+def HitTest(geometry, block, engine="grid", propagation=None, bField=3.8, nTests=None):
+    """ Hit test a block of rays, return nHits, layerHits and layerHitPos, and
+        add the number of exact facet tests of each ray to nTests if given
+    """
+    hitPos = GetHitPos(geometry, block, propagation=propagation, bField=bField)
+
+    return ENGINES[engine](geometry, hitPos, nTests=nTests)
+
+# Geometry and hit test options of each worker process
+_worker = {}
+
+def _InitWorker(shared, options, countTests=False):
+    """ Rebuild geometry in worker process from shared memory """
+    from geometry import Geometry
+    _worker["geometry"] = Geometry.FromArrays(UnshareArrays(shared))
+    _worker["options"] = options
+    _worker["countTests"] = countTests
+    return
+
+def _HitTestShard(block):
+    """ Hit test one shard of rays in a worker process, also return the
+        number of exact facet tests of each ray if counting them
+    """
+    if not _worker["countTests"]:
+        return HitTest(_worker["geometry"], block, **_worker["options"])
+    nTests = np.zeros(len(block), dtype=np.int64)
+    return tuple(HitTest(_worker["geometry"], block, nTests=nTests, **_worker["options"]))+(nTests,)
+
+def StartPool(geometry, nWorkers, options, countTests=False):
+    """ Start a pool of nWorkers processes that hit test with the given
+        options, sharing the geometry with them rather than pickling it for
+        each of them
+    """
+    shared = ShareArrays(geometry.GetArrays())
+    return multiprocessing.Pool(nWorkers, initializer=_InitWorker,
+                                initargs=(shared, options, countTests))
+
+def IterHits(geometry, rays, engine="grid", blockSize=4096, nWorkers=1,
+             propagation=None, bField=3.8, stats=None, pool=None):
+    """ Hit test rays, yield (block of rays, nHits, layerHits, layerHitPos)
+        in the original ray order, split across nWorkers processes if > 1.
+        Rays are propagated to each layer's z-plane along a "straight" line
+        or a "helix" in a bField Tesla solenoid field if propagation is set.
+        Exact facet tests of each ray are added to stats if given. Workers
+        can be reused from a pool started by StartPool with the same
+        options, which is left running.
+    """
+    if engine not in ENGINES:
+        raise ValueError("Unknown hit-testing engine: {}".format(engine))
+    options = {"engine": engine, "propagation": propagation, "bField": bField}
+    blocks = IterBlocks(rays, blockSize)
+    if nWorkers <= 1:
+        for block in blocks:
+            if stats is None:
+                yield (block,)+tuple(HitTest(geometry, block, **options))
+                continue
+            nTests = np.zeros(len(block), dtype=np.int64)
+            result = HitTest(geometry, block, nTests=nTests, **options)
+            stats.AddTests(nTests)
+            yield (block,)+tuple(result)
+        return
+    isOwnPool = (pool is None)
+    if isOwnPool:
+        pool = StartPool(geometry, nWorkers, options, countTests=(stats is not None))
+    try:
+        while True:
+            # Only keep a few blocks per worker in memory at once
+            window = list(islice(blocks, 4*nWorkers))
+            if not window: break
+            for block, result in zip(window, pool.map(_HitTestShard, window)):
+                if stats is not None:
+                    stats.AddTests(result[3])
+                yield (block,)+tuple(result[:3])
+    finally:
+        if isOwnPool:
+            pool.terminate()
+            pool.join()
+
+def GetInputHash(geometry, params):
+    """ Hash geometry and the parameters that determine hit test results """
+    sha = hashlib.sha1(json.dumps(params, sort_keys=True).encode("utf-8"))
+    for array in (geometry.vertices, geometry.normals, geometry.offsets):
+        sha.update(np.ascontiguousarray(array).tobytes())
+
+    return sha.hexdigest()
+
+def LoadMarker(ckptDir, inputHash):
+    """ Load checkpoint marker, or start a new one if it is missing or was
+        written for a different input
+    """
+    markerPath = os.path.join(ckptDir, "marker.json")
+    if os.path.isfile(markerPath):
+        with open(markerPath, "r") as fin:
+            marker = json.load(fin)
+        if marker["inputHash"] == inputHash:
+            return marker
+
+    return {"inputHash": inputHash, "nextRay": 0, "chunks": []}
+
+def WriteAtomic(path, write):
+    """ Call write(fout) on a temporary file, then move it to path, so that a
+        killed job never leaves a partial file behind
+    """
+    tmpPath = "{0}.{1}.tmp".format(path, os.getpid())
+    with open(tmpPath, "wb") as fout:
+        write(fout)
+    os.rename(tmpPath, path)
+    return
+
+def IterCheckpointed(geometry, rays, ckptDir, checkpointEvery=100000, engine="grid",
+                     blockSize=4096, nWorkers=1, propagation=None, bField=3.8, verbose=False,
+                     stats=None):
+    """ Same as IterHits, but save the results of every checkpointEvery rays
+        to ckptDir along with a marker of the input hash and the next ray,
+        and reuse the saved results of an interrupted run on the same input.
+        Worker processes are started once and reused for every chunk.
+    """
+    if engine not in ENGINES:
+        raise ValueError("Unknown hit-testing engine: {}".format(engine))
+    inputHash = GetInputHash(geometry, {"propagation": propagation, "bField": bField,
+                                        "checkpointEvery": checkpointEvery})
+    options = {"engine": engine, "propagation": propagation, "bField": bField}
+    if not os.path.isdir(ckptDir): os.makedirs(ckptDir)
+    marker = LoadMarker(ckptDir, inputHash)
+    nRays = 0
+    nResumed = 0
+    pool = None
+    try:
+        for k, chunk in enumerate(IterBlocks(rays, checkpointEvery)):
+            chunkPath = os.path.join(ckptDir, "chunk_{}.npz".format(k))
+            rayHash = hashlib.sha1(np.ascontiguousarray(chunk).tobytes()).hexdigest()
+            if k < len(marker["chunks"]) and marker["chunks"][k] == rayHash:
+                with np.load(chunkPath) as saved:
+                    results = (saved["nHits"], saved["layerHits"], saved["layerHitPos"])
+                nResumed += len(chunk)
+            else:
+                if pool is None and nWorkers > 1:
+                    pool = StartPool(geometry, nWorkers, options, countTests=(stats is not None))
+                results = tuple(np.concatenate(arrays) for arrays in zip(*[
+                    result[1:] for result in IterHits(geometry, chunk, blockSize=blockSize,
+                                                      nWorkers=nWorkers, stats=stats, pool=pool,
+                                                      **options) ]))
+                WriteAtomic(chunkPath, lambda fout: np.savez(fout, nHits=results[0], layerHits=results[1],
+                                                             layerHitPos=results[2]))
+                marker["chunks"] = marker["chunks"][:k]+[rayHash]
+                marker["nextRay"] = nRays+len(chunk)
+                WriteAtomic(os.path.join(ckptDir, "marker.json"),
+                            lambda fout: fout.write(json.dumps(marker).encode("utf-8")))
+            nRays += len(chunk)
+            yield (chunk,)+results
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    if verbose and nResumed:
+        print("Resumed {0} rays from checkpoint {1}".format(nResumed, ckptDir))
+
+def Parse(geometry, rays, outPath, verbose=False, engine="grid", blockSize=4096, nWorkers=1,
+          propagation=None, bField=3.8, checkpointEvery=None, ckptDir=None, stats=None,
+          efficiency=True, effWeights=None, weighted=False):
+    """ Parse polygons and rays, look for hits, where rays is a structured
+        array of rays or an iterable of such arrays. Return summary counts
+        of rays, rays with at least one hit, hits and hits per layer. If
+        checkpointEvery is set, checkpoint results to ckptDir (default:
+        outPath+".ckpt") so that an interrupted run can be resumed. If stats (instrument.Stats) is
+        given, record timing and hit test statistics and write them to the
+        output file as a "Metadata" JSON string. Output is written without
+        ROOT if outPath ends with .npz. If efficiency is set, accumulate the
+        ChronoPlots efficiencies (weighted with effWeights, a WeightTable or
+        table file, if given) while hit testing, store them in the output and
+        return them as summary["efficiency"]; efficiency can also be an
+        EffAccumulator to accumulate into. If weighted is set, rays carry
+        importance weights (rays.AddWeights), stored as a "weight" branch.
+    """
+    # Setup output file
+    isNpz = (outPath.split(".")[-1] == "npz")
+    if isNpz:
+        # Spool branches next to the output
+        rayOut = NpzTree(nLayers=len(geometry), weighted=weighted,
+                         tmpDir=os.path.dirname(os.path.abspath(outPath)))
+    else:
+        import ROOT
+        outFile = ROOT.TFile(outPath, "RECREATE")
+        rayOut = OutTree(nLayers=len(geometry), weighted=weighted)
+    nTotal = 0
+    summary = {"nRays": 0, "nHitRays": 0, "layerHits": np.zeros(len(geometry), dtype=int)}
+    if isinstance(efficiency, EffAccumulator):
+        effAcc = efficiency
+    else:
+        effAcc = EffAccumulator(nLayers=len(geometry), weights=effWeights) if efficiency else None
+    options = {"engine": engine, "blockSize": blockSize, "nWorkers": nWorkers,
+               "propagation": propagation, "bField": bField, "stats": stats}
+    if checkpointEvery is None:
+        hits = IterHits(geometry, rays, **options)
+    else:
+        ckptDir = outPath+".ckpt" if ckptDir is None else ckptDir
+        hits = IterCheckpointed(geometry, rays, ckptDir, checkpointEvery=checkpointEvery,
+                                verbose=verbose, **options)
+    # Loop over blocks of rays
+    for block, nHits, layerHits, layerHitPos in TimeIter(stats, "hit test", hits):
+        nTotal += nHits.sum()
+        summary["nRays"] += len(block)
+        summary["nHitRays"] += int(np.count_nonzero(nHits))
+        summary["layerHits"] += np.count_nonzero(layerHits, axis=0)
+        if stats is not None: stats.AddHits(layerHits)
+        if effAcc is not None: effAcc.Update(block, layerHits)
         # Fill tree
-        rayOut.Fill()
+        with Stage(stats, "tree fill"):
+            rayOut.FillBlock(block, nHits, layerHits, layerHitPos)
 
     if verbose:
-        print("{} hits".format(nHits))
+        print("{} hits".format(nTotal))
         print("Finished")
 
-    rayOut.tree.Write()
-    outFile.Close()
+    if isNpz:
+        with Stage(stats, "tree write"):
+            rayOut.Write(outPath)
+        AppendArrays(outPath, effAcc.GetArrays() if effAcc is not None else {},
+                     metadata=stats.ToJSON() if stats is not None else None)
+    else:
+        with Stage(stats, "tree write"):
+            rayOut.tree.Write()
+        if stats is not None:
+            ROOT.TNamed("Metadata", stats.ToJSON()).Write()
+        if effAcc is not None:
+            effAcc.WriteRoot(outFile.mkdir("Efficiency"))
+        outFile.Close()
+    summary["nHits"] = int(nTotal)
+    summary["efficiency"] = effAcc
+    # Output is complete, checkpoint is no longer needed
+    if checkpointEvery is not None:
+        shutil.rmtree(ckptDir)
+
+    return summary
+
+def GetSweepNames(stlDirs):
+    """ Return output name of each geometry of a sweep (its directory name),
+        raising a ValueError if names are not unique, since their outputs
+        would overwrite one another
+    """
+    names = [ os.path.basename(os.path.normpath(stlDir)) for stlDir in stlDirs ]
+    duplicates = sorted(set([ name for name in names if names.count(name) > 1 ]))
+    if duplicates:
+        raise ValueError("Geometries with the same directory name: {}".format(", ".join(duplicates)))
+    return names
+
+def WriteSummary(summaryPath, names, summaries):
+    """ Write table of overall and per-layer efficiencies (fraction of rays
+        with a hit) of each named geometry
+    """
+    nLayers = max([ len(summary["layerHits"]) for summary in summaries ]+[0])
+    header = ["geometry", "nRays", "nHits", "eff"]+[ "layer{}Eff".format(j) for j in range(nLayers) ]
+    with open(summaryPath, "w") as fout:
+        fout.write(" ".join(header)+"\n")
+        for name, summary in zip(names, summaries):
+            nRays = max(summary["nRays"], 1)
+            row = [ name, str(summary["nRays"]), str(summary["nHits"]),
+                    "{:.6f}".format(float(summary["nHitRays"])/nRays) ]
+            row += [ "{:.6f}".format(float(n)/nRays) for n in summary["layerHits"] ]
+            row += [ "-" ]*(nLayers-len(summary["layerHits"]))
+            fout.write(" ".join(row)+"\n")
 
     return
 
 if __name__ == "__main__":
     import sys
+    from etlsim import LoadMesh, Run
     if sys.argv[2] == "-debug":
         stlDir = sys.argv[1]
         LoadMesh(stlDir, sf=(0.001), verbose=True)
@@ -117,4 +503,8 @@ if __name__ == "__main__":
         stlDir = sys.argv[1]
         rayPath = sys.argv[2]
         outPath = sys.argv[3]
-        Parse(stlDir, rayPath, outPath, verbose=True)
+        # Checkpoint so that preempted jobs can resume, to a directory kept
+        # across evictions if given
+        ckptDir = sys.argv[4] if len(sys.argv) > 4 else None
+        Run(stlDir, rayPath, outPath, verbose=True, chunkSize=100000, checkpointEvery=100000,
+            ckptDir=ckptDir)
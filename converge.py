@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+from chronosim import GetHitPos, GetLayerPos, Parse
+from geometry import GetBoundaryEdges
+from efficiency import EffAccumulator
+from rays import AddWeights
+from instrument import Stage
+
+# Efficiency whose uncertainty decides convergence, if the geometry has it
+DEFAULT_TARGET = "Layer 0 OR 1 AND 2 OR 3"
+
+def GetCodes(cells):
+    """ Return int64 code of each (x, y) cell index """
+    cells = np.asarray(cells, dtype=np.int64)
+    return cells[:, 0]*2**32+cells[:, 1]
+
+def SampleSegments(segments, spacing):
+    """ Return points along (n, 2, 2) projected segments, spaced by at most spacing """
+    lengths = np.hypot(*(segments[:, 1]-segments[:, 0]).T)
+    counts = np.ceil(lengths/spacing).astype(int)+1
+    owner = np.repeat(np.arange(len(segments)), counts)
+    local = np.arange(counts.sum())-np.repeat(np.cumsum(counts)-counts, counts)
+    t = (local/(counts[owner]-1.))[:, np.newaxis]
+    return segments[owner, 0]+t*(segments[owner, 1]-segments[owner, 0])
+
+class EdgeMap:
+    def __init__(self, geometry, distance=1e-3):
+        """ Cells of size distance, in the projection frame of each facet grid
+            of each layer, around the boundary edges of the layer (module
+            edges and gaps)
+        """
+        self.distance = distance
+        self.maps = []
+        for j in range(len(geometry)):
+            edges, owners = GetBoundaryEdges(geometry, j)
+            layerMaps = []
+            for grid in geometry.grids[j]:
+                segments = np.einsum("ij,evj->evi", grid.frame, edges[np.isin(owners, grid.facets)])
+                cells = np.floor(SampleSegments(segments, 0.5*distance)/distance)
+                codes = np.sort(GetCodes(cells))
+                codes = codes[np.append(True, np.diff(codes) != 0)] if len(codes) else codes
+                normal = geometry.normals[grid.facets[0]]
+                layerMaps.append((grid.frame, normal, codes))
+            self.maps.append(layerMaps)
+
+    def IsNear(self, hitPos):
+        """ Return whether each hit position (shared by all layers, or per
+            layer as in HitTest) lies within about distance of a boundary edge
+            on any layer, as seen from the front of its facets
+        """
+        layerPos = GetLayerPos(hitPos, len(self.maps))
+        isNear = np.zeros(len(layerPos), dtype=bool)
+        for j, layerMaps in enumerate(self.maps):
+            for frame, normal, codes in layerMaps:
+                if len(codes) == 0: continue
+                pos = layerPos[:, j]
+                cells = np.floor(np.dot(pos, frame.T)/self.distance)
+                isValid = np.all(np.isfinite(cells), axis=1) & (np.dot(pos, normal) >= 0)
+                cells[~isValid] = 0
+                for offset in [ (dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1) ]:
+                    neighbors = GetCodes(cells+offset)
+                    index = np.minimum(np.searchsorted(codes, neighbors), len(codes)-1)
+                    isNear |= isValid & (codes[index] == neighbors)
+
+        return isNear
+
+def GetTargets(acc, targets=None):
+    """ Return names of the target efficiencies of an EffAccumulator """
+    if targets is None:
+        targets = [DEFAULT_TARGET] if DEFAULT_TARGET in acc.names else acc.names
+    unknown = [ name for name in targets if name not in acc.names ]
+    if unknown:
+        raise ValueError("Unknown efficiencies: {}".format(", ".join(unknown)))
+    return targets
+
+def IsConverged(acc, precision, targets, weighted=False):
+    """ Return whether the uncertainty of every target efficiency (of the
+        weighted ratio estimator) is at most precision, never if an
+        efficiency has no entries
+    """
+    table = acc.EffTable(weighted=weighted)
+    return all(table[name][1] <= precision for name in targets)
+
+def SampleBlocks(rays, acc, precision, targets, blockSize=4096, minRays=10000, maxRays=None,
+                 isNear=None, oversample=1., weighted=False, seed=0):
+    """ Yield blocks of randomly drawn rays until at least minRays rays were
+        drawn and the target efficiencies accumulated in acc have converged
+        to precision, or maxRays (default: number of rays) were drawn. Rays
+        are drawn without replacement, unless rays near edges (isNear) are
+        oversampled by a factor oversample: then rays are drawn with
+        replacement and carry importance weights that keep the efficiencies
+        unbiased.
+    """
+    rng = np.random.RandomState(seed)
+    maxRays = len(rays) if maxRays is None else maxRays
+    isImportance = (isNear is not None and oversample != 1)
+    if isImportance:
+        prob = np.where(isNear, float(oversample), 1.)
+        prob /= prob.sum()
+        # Relative to drawing every ray with probability 1/nRays
+        weights = 1./(len(rays)*prob)
+    else:
+        order = rng.permutation(len(rays))
+        maxRays = min(maxRays, len(rays))
+    for start in range(0, maxRays, blockSize):
+        if start >= minRays and IsConverged(acc, precision, targets, weighted=weighted):
+            return
+        size = min(blockSize, maxRays-start)
+        if isImportance:
+            index = rng.choice(len(rays), size=size, p=prob)
+            yield AddWeights(rays[index], weights[index])
+        else:
+            yield rays[order[start:start+size]]
+
+def ParseConverged(geometry, rays, outPath, precision=1e-3, targets=None, minRays=10000,
+                   maxRays=None, oversample=1., edgeDistance=1e-3, seed=0, blockSize=4096,
+                   verbose=False, effWeights=None, stats=None, **options):
+    """ Parse randomly drawn blocks of rays (structured array, drawn from
+        at random so it is held in memory) until the uncertainty of each
+        target efficiency (default: layers 0 OR 1 AND 2 OR 3, eta-weighted
+        if effWeights is given) is at most precision. If oversample is not
+        1, oversample rays within about edgeDistance of module edges and
+        gaps by that factor, with importance weights. Other options are
+        passed to Parse, except checkpointEvery, since the drawn rays
+        depend on the efficiencies reached. Return Parse summary, with the
+        drawn rays as nRays and whether the target precision was reached
+        as "converged".
+    """
+    if not isinstance(rays, np.ndarray):
+        raise TypeError("Rays must be a structured array to be drawn at random")
+    if options.get("checkpointEvery") is not None:
+        raise ValueError("Cannot checkpoint a run that stops at a precision")
+    acc = EffAccumulator(nLayers=len(geometry), weights=effWeights)
+    targets = GetTargets(acc, targets)
+    isNear = None
+    if oversample != 1:
+        with Stage(stats, "edge map"):
+            edgeMap = EdgeMap(geometry, distance=edgeDistance)
+            hitPos = GetHitPos(geometry, rays, propagation=options.get("propagation"),
+                               bField=options.get("bField", 3.8))
+            isNear = edgeMap.IsNear(hitPos)
+        if verbose:
+            print("{0} of {1} rays near module edges, oversampled by {2}".format(
+                  np.count_nonzero(isNear), len(rays), oversample))
+    weighted = (effWeights is not None)
+    blocks = SampleBlocks(rays, acc, precision, targets, blockSize=blockSize, minRays=minRays,
+                          maxRays=maxRays, isNear=isNear, oversample=oversample,
+                          weighted=weighted, seed=seed)
+    summary = Parse(geometry, blocks, outPath, verbose=verbose, blockSize=blockSize, stats=stats,
+                    efficiency=acc, weighted=(isNear is not None), **options)
+    summary["converged"] = IsConverged(acc, precision, targets, weighted=weighted)
+    if verbose:
+        print("{0} after {1} rays".format("Converged" if summary["converged"] else "Did not converge",
+                                          summary["nRays"]))
+        table = acc.EffTable(weighted=weighted)
+        for name in targets:
+            print("{0}: {1:.6f} +/- {2:.6f}".format(name, *table[name]))
+
+    return summary
@@ -1,6 +1,5 @@
 import numpy as np
-from tqdm import tqdm
-from chronosim import LoadMesh
+from etlsim import LoadMesh
 
 class Output:
     def __init__(self):
@@ -14,50 +13,99 @@ class Output:
                                    "above": [],
                                    "below": [] }
 
-def FirstPass(output, layer, index, poly1, poly2):
-    """ Organize STL polygons into basic output form """
-    sameVert = 0
-    for vert1 in poly1:
-        if sameVert == 2: break
-        for vert2 in poly2:
-            if np.array_equal(vert2, vert1):
-                sameVert += 1
+def GetKeys(points, tol):
+    """ Return hashable keys of points quantized to a grid of spacing tol """
+    quantized = np.floor(np.asarray(points)/tol+0.5).astype(np.int64)
+    return [ tuple(key) for key in quantized.reshape(len(quantized), -1).tolist() ]
 
-    if sameVert == 2:
-        output.AddRect(layer, index, poly1[0])
-        return True
+def GetHypotenuses(polys):
+    """ Return (n, 2, 3) endpoints of the longest edge of each triangle, and
+        the (n, 3) vertex opposite to it
+    """
+    polys = np.asarray(polys, dtype=float)
+    opposite = np.argmax([ np.linalg.norm(polys[:, (k+2)%3]-polys[:, (k+1)%3], axis=1) for k in range(3) ], axis=0)
+    rows = np.arange(len(polys))
+    ends = np.stack((polys[rows, (opposite+1)%3], polys[rows, (opposite+2)%3]), axis=1)
+    return ends, polys[rows, opposite]
 
-    else:
-        return False
+def FirstPass(output, layer, polys, tol=1e-6):
+    """ Pair triangles of a layer that share their hypotenuse into LGAD
+        rectangles, stored at the rectangle center; return (good, bad) counts
+    """
+    if len(polys) == 0: return 0, 0
+    ends, opposite = GetHypotenuses(polys)
+    pairs = {}
+    keys1 = GetKeys(ends[:, 0], tol)
+    keys2 = GetKeys(ends[:, 1], tol)
+    for j in range(len(polys)):
+        # Same key for either order of the endpoints
+        key = min(keys1[j], keys2[j]) + max(keys1[j], keys2[j])
+        pairs.setdefault(key, []).append(j)
 
-def SecondPass(layers, resp1, verbose=False):
-    """ Associate all vertically-inline LGADs with one another """
-    return
+    good = 0
+    for indices in pairs.values():
+        if len(indices) != 2: continue
+        # The two triangles must lie on opposite sides of the shared edge
+        mid = ends[indices[0]].mean(axis=0)
+        if np.allclose(opposite[indices[0]]-mid, mid-opposite[indices[1]], atol=tol):
+            output.AddRect(layer, good, mid)
+            good += 1
+
+    return good, len(polys)-2*good
+
+def SecondPass(output, tol=1e-4, verbose=False):
+    """ Associate all vertically-inline LGADs with one another, linking each
+        LGAD to the inline LGADs of every later layer, not only the next one
+    """
+    layers = sorted(output.out)
+    # Spatial hash of rectangle xy-centers in each layer
+    lookup = {}
+    for layer in layers:
+        rects = output.out[layer]
+        centers = [ rect["pos"][:2] for rect in rects.values() ]
+        lookup[layer] = {}
+        for index, key in zip(rects, GetKeys(centers, tol) if centers else []):
+            lookup[layer].setdefault(key, []).append(index)
+
+    nLinks = 0
+    for below, above in [ (below, above) for i, below in enumerate(layers) for above in layers[i+1:] ]:
+        for index, rect in output.out[below].items():
+            x, y = GetKeys([rect["pos"][:2]], tol)[0]
+            # Check neighbouring cells, since centers may round differently
+            for key in [ (x+dx, y+dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1) ]:
+                for match in lookup[above].get(key, []):
+                    other = output.out[above][match]
+                    if np.hypot(*np.subtract(rect["pos"][:2], other["pos"][:2])) > tol: continue
+                    rect["above"].append((above, match))
+                    other["below"].append((below, index))
+                    nLinks += 1
 
-def Parse(layers, NthPass, verbose=False):
+    if verbose:
+        print("Associated {} pairs of vertically-inline LGADs".format(nLinks))
+
+    return nLinks
+
+def Parse(layers, verbose=False):
     """ Parse STL polygons """
     output = Output()
     good = 0
     bad = 0
     for i, layer in enumerate(layers):
         output.AddLayer(i)
-        for j, poly in enumerate(layer):
-            if j != len(layer)-1 and j%2 == 0:
-                poly1 = layer[j]
-                poly2 = layer[j+1]
-                result = NthPass(output, i, j, poly1, poly2)
-                if result:
-                    good += 1
-                else:
-                    bad += 1
+        nGood, nBad = FirstPass(output, i, layer)
+        good += nGood
+        bad += nBad
+
+    if verbose:
+        print("Found {0} LGADs ({1} unpaired polygons)".format(good, bad))
+    SecondPass(output, verbose=verbose)
 
     return output
 
 def Count(stlDir, verbose=False):
     # Load Layers
-    layers = LoadMesh(stlDir, sf=(0.001), verbose=verbose)
-    Parse(layers, FirstPass, verbose=verbose)
-    return
+    geometry = LoadMesh(stlDir, sf=(0.001), verbose=verbose)
+    return Parse(geometry.layers, verbose=verbose)
 
 if __name__ == "__main__":
     stlDir = "/nfs-7/userdata/jguiang/chronosim/stl/inline-2x2_41mmGap"
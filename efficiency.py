@@ -0,0 +1,246 @@
+import json
+import numpy as np
+from weights import WeightTable
+from rootutils import AsArray, GetBins, GetNCells
+
+# Binnings of the ChronoPlots eta, high eta and eta/pt efficiency histograms
+ETA_BINNING = (180, 1.2, 3.0)
+HIGH_ETA_BINNING = (180, 1.57, 2.85)
+ETA_PT_BINNING = (200, 0, 10, 180, 1.2, 3.0)
+# Counts (sums of ray weights), stored with their sum of squared weights
+COUNTS = ["num", "den"]
+# Eta-weighted counts, only kept with eta weights
+WEIGHTED = ["numW", "denW"]
+# Suffix of the sum of squared weights of each histogram
+SUMW2 = "Sumw2"
+
+def GetEffNames(nLayers):
+    """ Return names of the efficiencies of ChronoPlots.EffTable """
+    names = []
+    for i in range(nLayers):
+        names.append("Layer {}".format(i))
+        if i+1 < nLayers:
+            names.append("Layer {0} OR {1}".format(i, i+1))
+    if nLayers >= 4:
+        names.append("Layer 0 OR 1 AND 2 OR 3")
+    return names
+
+def GetEffMasks(layerHits):
+    """ Return (nRays, nEffs) numerator masks of the GetEffNames efficiencies """
+    nLayers = layerHits.shape[1]
+    masks = []
+    for i in range(nLayers):
+        masks.append(layerHits[:, i])
+        if i+1 < nLayers:
+            masks.append(layerHits[:, i] | layerHits[:, i+1])
+    if nLayers >= 4:
+        masks.append((layerHits[:, 0] | layerHits[:, 1]) & (layerHits[:, 2] | layerHits[:, 3]))
+    return np.stack(masks, axis=1) if masks else np.zeros((len(layerHits), 0), dtype=bool)
+
+class EffAccumulator:
+    def __init__(self, nLayers=4, ptCut=0.5, endcapOuterRad=1.27, endcapInnerRad=0.315, weights=None,
+                 weighted=None):
+        """ Streaming efficiency counts and eta, eta/pt histograms with the
+            cuts of ChronoPlots, mergeable by addition. Weighted counts use
+            eta weights from a WeightTable (or table file), and are only kept
+            if weights are given (or weighted is set, e.g. when loading them).
+        """
+        self.nLayers = nLayers
+        self.ptCut = ptCut
+        self.endcapOuterRad = endcapOuterRad
+        self.endcapInnerRad = endcapInnerRad
+        if weights is not None and not isinstance(weights, WeightTable):
+            weights = WeightTable.FromFile(weights)
+        self.weights = weights
+        self.weighted = (weights is not None) if weighted is None else weighted
+        self.names = GetEffNames(nLayers)
+        self.binnings = {}
+        self.arrays = {}
+        for name in self.GetCounts():
+            self.arrays[name] = np.zeros(len(self.names))
+            self.arrays[name+"2"] = np.zeros(len(self.names))
+        for i in range(nLayers-1):
+            plotID = str(i)+str(i+1)
+            for prefix in ["hit", "all"]:
+                self.binnings[prefix+"eta"+plotID] = ETA_BINNING
+                self.binnings[prefix+"eta"+plotID+"HighEta"] = HIGH_ETA_BINNING
+                self.binnings[prefix+"etapt"+plotID] = ETA_PT_BINNING
+        for name, binning in self.binnings.items():
+            self.arrays[name] = np.zeros(GetNCells(binning))
+            self.arrays[name+SUMW2] = np.zeros(GetNCells(binning))
+
+    def GetParams(self):
+        return {"nLayers": self.nLayers, "ptCut": self.ptCut, "weighted": self.weighted,
+                "endcapOuterRad": self.endcapOuterRad, "endcapInnerRad": self.endcapInnerRad}
+
+    def GetCounts(self):
+        """ Return names of the counts kept by this accumulator """
+        return COUNTS+(WEIGHTED if self.weighted else [])
+
+    def Fill(self, name, values, mask, weight):
+        """ Add weighted entries passing mask to histogram name """
+        bins = GetBins([ vals[mask] for vals in values ], self.binnings[name])
+        isValid = (bins >= 0)
+        weight = weight[mask][isValid]
+        nCells = len(self.arrays[name])
+        self.arrays[name] += np.bincount(bins[isValid], weights=weight, minlength=nCells)
+        self.arrays[name+SUMW2] += np.bincount(bins[isValid], weights=weight**2, minlength=nCells)
+        return
+
+    def AddCounts(self, suffix, weight, numerators, denominator):
+        """ Add sums of weights (and squared weights) of numerator and
+            denominator entries to the counts ending with suffix
+        """
+        self.arrays["num"+suffix] += np.dot(weight, numerators)
+        self.arrays["num"+suffix+"2"] += np.dot(weight**2, numerators)
+        self.arrays["den"+suffix] += weight[denominator].sum()
+        self.arrays["den"+suffix+"2"] += (weight[denominator]**2).sum()
+        return
+
+    def Update(self, rays, layerHits, rayWeights=None):
+        """ Add a block of rays (structured array) and their (nRays, nLayers)
+            layer hits, optionally with per-ray (e.g. importance) weights,
+            taken from the "weight" field of the rays if not given. Ray
+            weights enter every count and histogram, eta weights only the
+            weighted counts.
+        """
+        layerHits = np.asarray(layerHits, dtype=bool)
+        if rayWeights is None:
+            rayWeights = rays["weight"] if "weight" in rays.dtype.names else np.ones(len(rays))
+        rayWeights = np.asarray(rayWeights, dtype=float)
+        pt, eta = rays["pt"], rays["eta"]
+        x, y = rays["pos"][:, 0], rays["pos"][:, 1]
+        r = (x*x+y*y)**0.5
+        # Same selections as ChronoPlots.Denominator and EffTable
+        denominator = (pt > self.ptCut) & (r < self.endcapOuterRad) & (r > self.endcapInnerRad)
+        numerators = GetEffMasks(layerHits) & denominator[:, np.newaxis]
+        self.AddCounts("", rayWeights, numerators, denominator)
+        if self.weighted:
+            self.AddCounts("W", self.weights(eta)*rayWeights, numerators, denominator)
+        # Same selections as ChronoPlots.BookLayerEtaEff and BookLayerEtaPtEff
+        isPt = (pt > 0.5)
+        isHighEta = isPt & (eta > 1.4) & (eta < 2.9)
+        for i in range(self.nLayers-1):
+            plotID = str(i)+str(i+1)
+            layerOr = layerHits[:, i] | layerHits[:, i+1]
+            self.Fill("hiteta"+plotID, [eta], layerOr & isPt, rayWeights)
+            self.Fill("alleta"+plotID, [eta], isPt, rayWeights)
+            self.Fill("hiteta"+plotID+"HighEta", [eta], layerOr & isHighEta, rayWeights)
+            self.Fill("alleta"+plotID+"HighEta", [eta], isHighEta, rayWeights)
+            self.Fill("hitetapt"+plotID, [pt, eta], layerOr, rayWeights)
+            self.Fill("alletapt"+plotID, [pt, eta], np.ones(len(rays), dtype=bool), rayWeights)
+        return
+
+    def Add(self, other):
+        """ Add counts of another accumulator with the same parameters """
+        if other.GetParams() != self.GetParams():
+            raise ValueError("Cannot merge efficiencies with different parameters")
+        for name in self.arrays:
+            self.arrays[name] += other.arrays[name]
+        return self
+
+    def EffTable(self, weighted=False):
+        """ Return dict of efficiency name to (efficiency, uncertainty), the
+            ratio sum(w y)/sum(w) of the (eta-)weighted counts and the square
+            root of its variance sum(w^2 (y-eff)^2)/sum(w)^2, which is the
+            binomial uncertainty for unit weights
+        """
+        if weighted and not self.weighted:
+            raise ValueError("Efficiencies were accumulated without eta weights")
+        a = self.arrays
+        suffix = "W" if weighted else ""
+        num, num2 = a["num"+suffix], a["num"+suffix+"2"]
+        den, den2 = a["den"+suffix], a["den"+suffix+"2"]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            eff = num/den
+            # sum(w^2 (y-eff)^2) with y in {0, 1}
+            sumSq = num2*(1-2*eff)+eff**2*den2
+            err = np.maximum(sumSq, 0)**0.5/den
+        return dict((name, (eff[k], err[k])) for k, name in enumerate(self.names))
+
+    def GetArrays(self):
+        """ Return dict of arrays (and JSON parameters) for an .npz file """
+        arrays = dict(("eff_"+name, array) for name, array in self.arrays.items())
+        arrays["eff_params"] = np.array(json.dumps(self.GetParams(), sort_keys=True))
+        return arrays
+
+    @classmethod
+    def FromArrays(cls, arrays):
+        acc = cls(**json.loads(str(arrays["eff_params"])))
+        for name in acc.arrays:
+            acc.arrays[name] = np.array(arrays["eff_"+name], dtype=float)
+        return acc
+
+    def WriteRoot(self, tDirectory):
+        """ Write counts and histograms, with their sums of squared weights,
+            into a ROOT directory, as histograms that hadd merges by addition
+        """
+        import ROOT
+        tDirectory.cd()
+        ROOT.TNamed("params", json.dumps(self.GetParams(), sort_keys=True)).Write()
+        for name in self.GetCounts():
+            hist = ROOT.TH1D(name, "", len(self.names), 0, len(self.names))
+            for k, label in enumerate(self.names):
+                hist.GetXaxis().SetBinLabel(k+1, label)
+            hist.Sumw2()
+            AsArray(hist.GetArray(), hist.GetNcells())[1:-1] = self.arrays[name]
+            AsArray(hist.GetSumw2().GetArray(), hist.GetNcells())[1:-1] = self.arrays[name+"2"]
+            hist.Write()
+        for name, binning in sorted(self.binnings.items()):
+            hist = ROOT.TH1D(name, "", *binning) if len(binning) == 3 else ROOT.TH2D(name, "", *binning)
+            hist.Sumw2()
+            AsArray(hist.GetArray(), hist.GetNcells())[:] = self.arrays[name]
+            AsArray(hist.GetSumw2().GetArray(), hist.GetNcells())[:] = self.arrays[name+SUMW2]
+            hist.SetEntries(self.arrays[name].sum())
+            hist.Write()
+        return
+
+    @classmethod
+    def FromRoot(cls, tDirectory):
+        acc = cls(**json.loads(tDirectory.Get("params").GetTitle()))
+        for name in acc.GetCounts():
+            hist = tDirectory.Get(name)
+            acc.arrays[name] = np.array(AsArray(hist.GetArray(), hist.GetNcells())[1:-1])
+            acc.arrays[name+"2"] = np.array(AsArray(hist.GetSumw2().GetArray(), hist.GetNcells())[1:-1])
+        for name in acc.binnings:
+            hist = tDirectory.Get(name)
+            acc.arrays[name] = np.array(AsArray(hist.GetArray(), hist.GetNcells()))
+            acc.arrays[name+SUMW2] = np.array(AsArray(hist.GetSumw2().GetArray(), hist.GetNcells()))
+        return acc
+
+def LoadEfficiency(outPath):
+    """ Load efficiency accumulator stored in a Parse output (.root or .npz) """
+    if outPath.split(".")[-1] == "npz":
+        with np.load(outPath) as arrays:
+            return EffAccumulator.FromArrays(arrays)
+    import ROOT
+    tFile = ROOT.TFile.Open(outPath)
+    acc = EffAccumulator.FromRoot(tFile.Get("Efficiency"))
+    tFile.Close()
+    return acc
+
+def MergeEfficiency(outPaths):
+    """ Return sum of the efficiency accumulators of several outputs """
+    total = None
+    for outPath in outPaths:
+        acc = LoadEfficiency(outPath)
+        total = acc if total is None else total.Add(acc)
+    return total
+
+def WriteEffTable(effPath, names, accumulators, weighted=False):
+    """ Write table of the efficiencies (and uncertainties) of each named
+        accumulator, e.g. of each geometry of a sweep
+    """
+    effNames = []
+    for acc in accumulators:
+        effNames += [ name for name in acc.names if name not in effNames ]
+    with open(effPath, "w") as fout:
+        columns = [ name.replace(" ", "_") for name in effNames ]
+        fout.write("geometry "+" ".join([ "{0} {0}_err".format(column) for column in columns ])+"\n")
+        for name, acc in zip(names, accumulators):
+            table = acc.EffTable(weighted=weighted)
+            row = [name]
+            for effName in effNames:
+                row += [ "{:.6f}".format(value) for value in table[effName] ] if effName in table else ["-", "-"]
+            fout.write(" ".join(row)+"\n")
+    return
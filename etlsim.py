@@ -1,26 +1,42 @@
 # -*- coding: utf-8 -*-
-from stl import mesh
+import numpy as np
 import os
-from chronosim import Parse
+from chronosim import Parse, WriteSummary, GetSweepNames
+from converge import ParseConverged
+from geometry import Geometry, LoadCached
+from rays import LoadRays, IterRays
+from instrument import Stats, Stage, TimeIter
+from efficiency import WriteEffTable
 
-def LoadMesh(stlDir, sf=1, verbose=False):
-    """ Load polygon mesh, only return polygons with normal in z-direction """
+def CompileMesh(stlDir, sf=1):
+    """ Read polygon mesh, only keep polygons with normal in z-direction """
+    # Only load numpy-stl when compiling a mesh, not when it is cached
+    from stl import mesh
     layers = []
-    for i, stlFile in enumerate(sorted(os.listdir(stlDir))):
+    norms = []
+    for stlFile in sorted(os.listdir(stlDir)):
         lgadMesh = mesh.Mesh.from_file("{0}/{1}".format(stlDir, stlFile))
-        allVectors = lgadMesh.vectors
-        layers.append([])
-        for j, n in enumerate(lgadMesh.normals):
-            if (n[2] > 0):
-                # Calculate area
-                a = (n[0]**2+n[1]**2+n[2]**2)**0.5
-                layers[i].append([ allVectors[j][0]*sf, allVectors[j][1]*sf, allVectors[j][2]*sf ])
-                norms[i].append([n[0]/a, n[1]/a, n[2]/a])
+        n = lgadMesh.normals
+        # Calculate area
+        a = (n[:, 0]**2+n[:, 1]**2+n[:, 2]**2)**0.5
+        keep = (n[:, 2] > 0)
+        layers.append(lgadMesh.vectors[keep]*sf)
+        norms.append(n[keep]/a[keep, np.newaxis])
+
+    return Geometry.FromLayers(layers, norms)
+
+def LoadMesh(stlDir, sf=1, verbose=False, cacheDir=None, stats=None):
+    """ Load polygon mesh, only return polygons with normal in z-direction """
+    with Stage(stats, "mesh load"):
+        if cacheDir is None:
+            geometry = CompileMesh(stlDir, sf=sf)
+        else:
+            geometry = LoadCached(stlDir, cacheDir, CompileMesh, {"sf": sf}, tag="etl", verbose=verbose)
 
     if verbose:
         print("Loaded polygons from directory: {}".format(stlDir))
         nLGAD = 0 
-        for k, layer in enumerate(layers):
+        for k, layer in enumerate(geometry.layers):
             print("{0} LGADs in layer {1}".format(len(layer)/2, k))
             nLGAD += len(layer)/2
         nASIC = nLGAD*2
@@ -33,45 +49,88 @@ def LoadMesh(stlDir, sf=1, verbose=False):
         print("______________________________________")
         print("= ${} total".format(140*nLGAD+60*nASIC))
 
-    return layers, norms
-
-def LoadRays(rayPath, verbose=False):
-    """ Load ray trajectory data from txt file, map to dict """
-    rays = []
-    with open(rayPath, "r") as rayFile:
-        for line in rayFile.readlines():
-            ray = [ float(val) for val in line.split() ]
-            rays.append({ "id":     ray[0],
-                          "mass":   ray[1],
-                          "charge": ray[2],
-                          "pt":     ray[3],
-                          "eta":    ray[4],
-                          "phi":    ray[5],
-                          "pos":    [ ray[6], ray[7], ray[8] ],
-                          "p":    [ ray[9], ray[10], ray[11] ]}) 
-    if verbose:
-        print("Loaded {0} trajectories from file {1}".format(len(rays), rayPath))
-
-    return rays
+    return geometry
 
-def Run(stlDir, rayPath, outPath, verbose=True):
-    """ Load data and run simulation """
-    # Load layers and normal vectors
-    layers, norms = LoadMesh(stlDir, sf=(0.001), verbose=verbose)
+def Run(stlDir, rayPath, outPath, verbose=True, engine="grid", cacheDir=None,
+        chunkSize=None, nWorkers=1, propagation=None, bField=3.8, checkpointEvery=None,
+        ckptDir=None, instrument=False, precision=None, oversample=1., effWeights=None):
+    """ Load data and run simulation, stream rays in chunks if chunkSize is set
+        and hit test them with nWorkers processes. If propagation is "straight"
+        or "helix", hit test each layer at the ray's position on its z-plane.
+        Checkpoint every checkpointEvery rays if set, to resume interrupted runs,
+        in ckptDir (default: outPath+".ckpt").
+        If instrument is set, record run statistics in the output and print them.
+        If precision is set, hit test randomly drawn rays (oversampling rays
+        near module edges by oversample) until the efficiency is that precise;
+        such runs load every ray and cannot use chunkSize or checkpointEvery.
+        Weighted efficiencies use eta weights effWeights (table or file) if given.
+    """
+    if precision is not None and (chunkSize is not None or checkpointEvery is not None):
+        raise ValueError("Cannot stream or checkpoint a run that stops at a precision")
+    stats = Stats() if instrument else None
+    # Load layers, normal vectors and facet projection frames
+    geometry = LoadMesh(stlDir, sf=(0.001), verbose=verbose, cacheDir=cacheDir, stats=stats)
     # Load rays
-    rays = LoadRays(rayPath, verbose=verbose)
+    if chunkSize is None:
+        with Stage(stats, "ray load"):
+            rays = LoadRays(rayPath, verbose=verbose)
+    else:
+        rays = TimeIter(stats, "ray load", IterRays(rayPath, chunkSize=chunkSize))
     # Run simulation
-    Parse(layers, norms, rays, outPath, verbose=verbose)
+    if precision is None:
+        Parse(geometry, rays, outPath, verbose=verbose, engine=engine, nWorkers=nWorkers,
+              propagation=propagation, bField=bField, checkpointEvery=checkpointEvery,
+              ckptDir=ckptDir, stats=stats, effWeights=effWeights)
+    else:
+        ParseConverged(geometry, rays, outPath, precision=precision, oversample=oversample,
+                       verbose=verbose, engine=engine, nWorkers=nWorkers, propagation=propagation,
+                       bField=bField, stats=stats, effWeights=effWeights)
+    if stats is not None: stats.Print()
 
     return
 
+def Sweep(stlDirs, rayPath, outDir, verbose=True, engine="grid", cacheDir=None,
+          nWorkers=1, propagation=None, bField=3.8, instrument=False, effWeights=None):
+    """ Load rays once and run simulation on each geometry in stlDirs, writing
+        {outDir}/{geometry}.root, a summary table {outDir}/summary.txt and a
+        table of ChronoPlots efficiencies {outDir}/efficiency.txt (and
+        {outDir}/efficiency_weighted.txt with eta weights effWeights, if
+        given), with run statistics of each geometry in its output if
+        instrument is set. Geometries are named by their directory name,
+        which must be unique
+    """
+    names = GetSweepNames(stlDirs)
+    if not os.path.isdir(outDir): os.makedirs(outDir)
+    rays = LoadRays(rayPath, verbose=verbose)
+    summaries = []
+    for stlDir, name in zip(stlDirs, names):
+        stats = Stats() if instrument else None
+        geometry = LoadMesh(stlDir, sf=(0.001), verbose=verbose, cacheDir=cacheDir, stats=stats)
+        outPath = os.path.join(outDir, "{}.root".format(name))
+        summaries.append(Parse(geometry, rays, outPath, verbose=verbose, engine=engine,
+                               nWorkers=nWorkers, propagation=propagation, bField=bField,
+                               stats=stats, effWeights=effWeights))
+        if stats is not None: stats.Print()
+
+    WriteSummary(os.path.join(outDir, "summary.txt"), names, summaries)
+    WriteEffTable(os.path.join(outDir, "efficiency.txt"), names,
+                  [ summary["efficiency"] for summary in summaries ])
+    if effWeights is not None:
+        WriteEffTable(os.path.join(outDir, "efficiency_weighted.txt"), names,
+                      [ summary["efficiency"] for summary in summaries ], weighted=True)
+
+    return summaries
+
 if __name__ == "__main__":
     import sys
-    if sys.argv[2] == "-debug":
+    if sys.argv[1] == "-sweep":
+        # Usage: -sweep rayPath outDir stlDir [stlDir ...]
+        Sweep(sys.argv[4:], sys.argv[2], sys.argv[3], verbose=True)
+    elif sys.argv[2] == "-debug":
         stlDir = sys.argv[1]
         LoadMesh(stlDir, sf=(0.001), verbose=True)
     else:
         stlDir = sys.argv[1]
         rayPath = sys.argv[2]
         outPath = sys.argv[3]
-        Parse(stlDir, rayPath, outPath, verbose=False)
+        Run(stlDir, rayPath, outPath, verbose=True)
@@ -0,0 +1,359 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import errno
+import hashlib
+import json
+import os
+from chronosim import GetTransforms
+
+# Per-facet arrays computed by Geometry.Prepare
+PREPARED = [ "frames", "triangles", "edges", "edgeConsts" ]
+# Version of the compiled geometry format, bump when CompileMesh or Prepare
+# change so that stale cache files are not loaded
+CACHE_VERSION = 1
+# Arrays held by each FacetGrid
+GRID_ARRAYS = [ "facets", "frame", "origin", "cellSize", "shape", "cellStart", "cellFacets" ]
+
+class Geometry:
+    def __init__(self, vertices, normals, offsets, prepared=None):
+        """ Layers of polygons stored in flat arrays, where the polygons of
+            layer j are vertices[offsets[j]:offsets[j+1]]
+        """
+        self.vertices = np.ascontiguousarray(vertices, dtype=float).reshape(-1, 3, 3)
+        self.normals = np.ascontiguousarray(normals, dtype=float).reshape(-1, 3)
+        self.offsets = np.asarray(offsets, dtype=int)
+        if prepared is None:
+            self.Prepare()
+        else:
+            self.SetArrays(prepared)
+
+    @classmethod
+    def FromLayers(cls, layers, norms):
+        """ Build geometry from per-layer lists of polygons and normal vectors """
+        offsets = np.cumsum([0]+[ len(layer) for layer in layers ])
+        vertices = np.zeros((offsets[-1], 3, 3))
+        normals = np.zeros((offsets[-1], 3))
+        for j in range(len(layers)):
+            if offsets[j] == offsets[j+1]: continue
+            vertices[offsets[j]:offsets[j+1]] = layers[j]
+            normals[offsets[j]:offsets[j+1]] = norms[j]
+
+        return cls(vertices, normals, offsets)
+
+    def Prepare(self):
+        """ Precompute projection frame of each facet """
+        # Rotation matrices into basis where z -> facet normal
+        self.frames = GetTransforms(self.normals)
+        # Facet vertices projected onto the facet plane
+        self.triangles = np.einsum("fij,fvj->fvi", self.frames[:, :2], self.vertices)
+        # Edge vectors from each projected vertex to the next one
+        self.edges = np.roll(self.triangles, -1, axis=1) - self.triangles
+        # z-component of (vertex x edge), so that for a projected hit pos h
+        # (vertex - h) x edge = edgeConsts - (h x edge)
+        self.edgeConsts = (self.triangles[..., 0]*self.edges[..., 1]
+                           - self.triangles[..., 1]*self.edges[..., 0])
+        # Spatial index over the facets of each layer
+        self.grids = [ BuildGrids(self, j) for j in range(len(self)) ]
+        self.routers = [ BuildRouter(self, j) for j in range(len(self)) ]
+        return
+
+    @classmethod
+    def FromArrays(cls, arrays):
+        """ Rebuild geometry from the output of GetArrays without recomputing it """
+        return cls(arrays["vertices"], arrays["normals"], arrays["offsets"], prepared=arrays)
+
+    def GetArrays(self):
+        """ Return dict of every array held by the geometry and its grids """
+        arrays = { "vertices": self.vertices, "normals": self.normals, "offsets": self.offsets }
+        for name in PREPARED:
+            arrays[name] = getattr(self, name)
+        arrays["nGrids"] = np.array([ len(grids) for grids in self.grids ], dtype=int)
+        for j, grids in enumerate(self.grids):
+            for g, grid in enumerate(grids):
+                for name in GRID_ARRAYS:
+                    arrays["grid_{0}_{1}_{2}".format(j, g, name)] = getattr(grid, name)
+
+        return arrays
+
+    def SetArrays(self, arrays):
+        """ Set precomputed per-facet arrays and grids from GetArrays output """
+        for name in PREPARED:
+            setattr(self, name, arrays[name])
+        self.grids = []
+        for j, nGrids in enumerate(arrays["nGrids"]):
+            self.grids.append([])
+            for g in range(nGrids):
+                gridArrays = [ arrays["grid_{0}_{1}_{2}".format(j, g, name)] for name in GRID_ARRAYS ]
+                self.grids[j].append(FacetGrid(*gridArrays))
+        self.routers = [ BuildRouter(self, j) for j in range(len(self)) ]
+        return
+
+    @classmethod
+    def Load(cls, path):
+        """ Load geometry compiled with Save. Only the facets are stored, so
+            Prepare still recomputes the frames, grids and routers.
+        """
+        with np.load(path) as data:
+            return cls(data["vertices"], data["normals"], data["offsets"])
+
+    def Save(self, path):
+        """ Write vertices, normals and layer offsets to a single .npz file """
+        with open(path, "wb") as fout:
+            np.savez(fout, vertices=self.vertices, normals=self.normals, offsets=self.offsets)
+        return
+
+    def __len__(self):
+        return len(self.offsets)-1
+
+    def Slice(self, j):
+        """ Return slice over the facets of layer j """
+        return slice(self.offsets[j], self.offsets[j+1])
+
+    @property
+    def layers(self):
+        return [ self.vertices[self.Slice(j)] for j in range(len(self)) ]
+
+    @property
+    def norms(self):
+        return [ self.normals[self.Slice(j)] for j in range(len(self)) ]
+
+    @property
+    def layerZ(self):
+        """ Mean z of the vertices in each layer (NaN for empty layers) """
+        return np.array([ layer[..., 2].mean() if len(layer) else np.nan for layer in self.layers ])
+
+def GetCacheKey(stlDir, params):
+    """ Hash the contents of every STL file in a directory, load parameters
+        and cache format version
+    """
+    params = dict(params, cacheVersion=CACHE_VERSION)
+    sha = hashlib.sha1(json.dumps(params, sort_keys=True).encode("utf-8"))
+    for stlFile in sorted(os.listdir(stlDir)):
+        sha.update(stlFile.encode("utf-8"))
+        with open("{0}/{1}".format(stlDir, stlFile), "rb") as fin:
+            for chunk in iter(lambda: fin.read(1 << 20), b""):
+                sha.update(chunk)
+
+    return sha.hexdigest()
+
+def LoadCached(stlDir, cacheDir, compiler, params, tag="geometry", verbose=False):
+    """ Load compiled geometry from cache, or compile it with
+        compiler(stlDir, **params) and add it to the cache. A cache hit skips
+        reading the STL files but still rebuilds every grid with Prepare.
+    """
+    cacheKey = GetCacheKey(stlDir, dict(params, tag=tag))
+    cachePath = "{0}/{1}_{2}.npz".format(cacheDir, tag, cacheKey)
+    if os.path.isfile(cachePath):
+        if verbose: print("Loaded cached geometry from {}".format(cachePath))
+        return Geometry.Load(cachePath)
+    geometry = compiler(stlDir, **params)
+    try:
+        os.makedirs(cacheDir)
+    except OSError as error:
+        # Another job may have created it in the meantime
+        if error.errno != errno.EEXIST: raise
+    # Write to a temporary file first so that concurrent jobs never read a partial file
+    tmpPath = "{0}.{1}.tmp".format(cachePath, os.getpid())
+    geometry.Save(tmpPath)
+    os.rename(tmpPath, cachePath)
+    if verbose: print("Wrote compiled geometry to {}".format(cachePath))
+
+    return geometry
+
+class FacetGrid:
+    def __init__(self, facets, frame, origin, cellSize, shape, cellStart, cellFacets):
+        """ Uniform grid over the projected bounding boxes of facets that share
+            the projection frame (first two rows of R), where the facets in
+            cell c are cellFacets[cellStart[c]:cellStart[c+1]]
+        """
+        self.facets = facets
+        self.frame = frame
+        self.origin = origin
+        self.cellSize = cellSize
+        self.shape = shape
+        self.cellStart = cellStart
+        self.cellFacets = cellFacets
+
+    def GetCells(self, points2D):
+        """ Return (x, y) grid cell indices of projected points """
+        return np.floor((points2D-self.origin)/self.cellSize).astype(int)
+
+    def Query(self, hitPos):
+        """ Return (ray index, facet index) pairs of candidate facets for an
+            (nRays, 3) array of hit positions
+        """
+        hitPosTransf = np.dot(hitPos, self.frame.T)
+        isFinite = np.all(np.isfinite(hitPosTransf), axis=1)
+        hitPosTransf[~isFinite] = self.origin
+        cells = self.GetCells(hitPosTransf)
+        isInside = isFinite & np.all((cells >= 0) & (cells < self.shape), axis=1)
+        cells = np.where(isInside, cells[:, 0]+self.shape[0]*cells[:, 1], 0)
+        first = self.cellStart[cells]
+        counts = np.where(isInside, self.cellStart[cells+1]-first, 0)
+        rayIndex = np.repeat(np.arange(len(hitPos)), counts)
+        local = np.arange(counts.sum())-np.repeat(np.cumsum(counts)-counts, counts)
+
+        return rayIndex, self.cellFacets[first[rayIndex]+local]
+
+def BuildGrid(facets, frame, triangles, pad=1e-5, maxCellsPerFacet=4):
+    """ Build FacetGrid over facets that share the projection frame, where
+        triangles are the facet vertices projected with that frame
+    """
+    facets = np.asarray(facets, dtype=int)
+    frame = np.asarray(frame, dtype=float)
+    # Facet bounding boxes, padded to absorb small differences between
+    # the shared frame and the frame of each individual facet
+    lo = triangles.min(axis=1)
+    hi = triangles.max(axis=1)
+    margin = pad*(1+np.abs(triangles).max())
+    lo -= margin
+    hi += margin
+    # Use typical facet size for grid cells, limit total number of cells
+    origin = lo.min(axis=0)
+    extent = hi.max(axis=0)-origin
+    cellSize = np.maximum(np.median(hi-lo, axis=0), 1e-3*extent.max())
+    nCells = np.ceil(extent/cellSize)
+    maxCells = maxCellsPerFacet*len(facets)
+    if nCells.prod() > maxCells:
+        cellSize = cellSize*(nCells.prod()/float(maxCells))**0.5
+    shape = np.maximum(np.ceil(extent/cellSize).astype(int), 1)
+    # Range of cells covered by each facet
+    cellLo = np.floor((lo-origin)/cellSize).astype(int)
+    cellHi = np.floor((hi-origin)/cellSize).astype(int)
+    cellLo = np.minimum(np.maximum(cellLo, 0), shape-1)
+    cellHi = np.minimum(np.maximum(cellHi, 0), shape-1)
+    width = cellHi[:, 0]-cellLo[:, 0]+1
+    counts = width*(cellHi[:, 1]-cellLo[:, 1]+1)
+    # Expand each facet into every cell it covers
+    owner = np.repeat(np.arange(len(facets)), counts)
+    local = np.arange(counts.sum())-np.repeat(np.cumsum(counts)-counts, counts)
+    cellX = cellLo[owner, 0]+local%width[owner]
+    cellY = cellLo[owner, 1]+local//width[owner]
+    cells = cellX+shape[0]*cellY
+    # Store as (cell start, facet) lists sorted by cell
+    order = np.argsort(cells, kind="mergesort")
+    cellFacets = facets[owner[order]]
+    cellStart = np.concatenate(([0], np.cumsum(np.bincount(cells, minlength=shape.prod()))))
+
+    return FacetGrid(facets, frame, origin, cellSize, shape, cellStart, cellFacets)
+
+def BuildGrids(geometry, j, decimals=7):
+    """ Build one FacetGrid per distinct facet normal direction in layer j """
+    facets = np.arange(geometry.offsets[j], geometry.offsets[j+1])
+    if len(facets) == 0:
+        return []
+    # Facets with the same normal share a projection frame
+    keys = np.round(geometry.normals[facets], decimals)
+    _, group = np.unique(keys, axis=0, return_inverse=True)
+    group = group.reshape(-1)
+    grids = []
+    for g in range(group.max()+1):
+        members = facets[group == g]
+        frame = geometry.frames[members[0], :2]
+        triangles = np.einsum("ij,fvj->fvi", frame, geometry.vertices[members])
+        grids.append(BuildGrid(members, frame, triangles))
+
+    return grids
+
+class GridRouter:
+    def __init__(self, nGrids, routed, centers, lo, hi, rhoMin):
+        """ Azimuthal index over the grids of a layer whose facet normals are
+            horizontal (e.g. barrel facets): a ray at xy-radius >= rhoMin can
+            only hit grid routed[k] if its azimuth is within [lo[k], hi[k]]
+            of centers[k]. Other grids are queried with every ray.
+        """
+        self.nGrids = nGrids
+        self.routed = routed
+        self.centers = centers
+        self.lo = lo
+        self.hi = hi
+        self.rhoMin = rhoMin
+
+    def Route(self, hitPos):
+        """ Return, for each grid, the indices of the rays of an (nRays, 3)
+            array of hit positions that it should query (None for every ray)
+        """
+        rayLists = [None]*self.nGrids
+        if len(self.routed) == 0:
+            return rayLists
+        rho = np.hypot(hitPos[:, 0], hitPos[:, 1])
+        phi = np.arctan2(hitPos[:, 1], hitPos[:, 0])
+        isFinite = np.all(np.isfinite(hitPos), axis=1)
+        # Rays close to the axis are sent to every routed grid
+        inner = np.nonzero(isFinite & (rho < self.rhoMin))[0]
+        outer = np.nonzero(isFinite & (rho >= self.rhoMin))[0]
+        outer = outer[np.argsort(phi[outer], kind="mergesort")]
+        sortedPhi = phi[outer]
+        # Start of each azimuthal range in [-pi, pi)
+        starts = np.mod(self.centers+self.lo+np.pi, 2*np.pi)-np.pi
+        stops = starts+(self.hi-self.lo)
+        for g, start, stop in zip(self.routed, starts, stops):
+            ranges = [(start, min(stop, np.pi))]
+            if stop > np.pi:
+                ranges.append((-np.pi, stop-2*np.pi))
+            index = [inner]
+            for low, high in ranges:
+                first = np.searchsorted(sortedPhi, low, side="left")
+                last = np.searchsorted(sortedPhi, high, side="right")
+                index.append(outer[first:last])
+            rayLists[g] = np.concatenate(index)
+
+        return rayLists
+
+def BuildRouter(geometry, j, pad=1e-5, eps=1e-9):
+    """ Build GridRouter over the grids of layer j whose facet normals all
+        have zero z-component, so that the first row of each facet's frame is
+        its xy-tangent (-ny, nx, 0)
+    """
+    grids = geometry.grids[j]
+    isFlat = [ np.all(geometry.normals[grid.facets, 2] == 0) for grid in grids ]
+    flat = [ grid.facets for grid, flat in zip(grids, isFlat) if flat ]
+    rhoMin = 0.
+    if flat:
+        vertices = geometry.vertices[np.concatenate(flat)]
+        rhoMin = 0.5*np.hypot(vertices[..., 0], vertices[..., 1]).min()
+    routed, centers, lo, hi = [], [], [], []
+    if rhoMin > 0:
+        for g, grid in enumerate(grids):
+            if not isFlat[g]: continue
+            normals = geometry.normals[grid.facets]
+            vertices = geometry.vertices[grid.facets]
+            # Tangential extent of each facet: a hit at xy-radius rho and
+            # azimuth offset d from the facet normal needs rho*sin(d) within
+            # it and cos(d) >= 0, so d is bounded for every rho >= rhoMin
+            t = normals[:, np.newaxis, 0]*vertices[..., 1]-normals[:, np.newaxis, 1]*vertices[..., 0]
+            margin = pad*(1+np.abs(t).max())
+            low = np.arcsin(np.clip(np.minimum(t.min(axis=1)-margin, 0)/rhoMin, -1, 1))
+            high = np.arcsin(np.clip(np.maximum(t.max(axis=1)+margin, 0)/rhoMin, -1, 1))
+            phi = np.arctan2(normals[:, 1], normals[:, 0])
+            center = phi[0]
+            offset = np.mod(phi-center+np.pi, 2*np.pi)-np.pi
+            routed.append(g)
+            centers.append(center)
+            lo.append((offset+low).min()-eps)
+            hi.append((offset+high).max()+eps)
+
+    return GridRouter(len(grids), np.array(routed, dtype=int), np.array(centers),
+                      np.array(lo), np.array(hi), rhoMin)
+
+def GetBoundaryEdges(geometry, j, decimals=7):
+    """ Return (nEdges, 2, 3) endpoints and facet indices of the facet edges
+        in layer j that no other facet of the layer shares, i.e. the edges
+        of its modules and of the gaps between them
+    """
+    facets = np.arange(geometry.offsets[j], geometry.offsets[j+1])
+    triangles = geometry.vertices[facets]
+    edges = np.stack((triangles, np.roll(triangles, -1, axis=1)), axis=2).reshape(-1, 2, 3)
+    owners = np.repeat(facets, 3)
+    # Key edges by their rounded endpoints, in a fixed order (+0. maps -0. to 0.)
+    keys = np.round(edges, decimals)+0.
+    diff = keys[:, 1]-keys[:, 0]
+    first = np.argmax(diff != 0, axis=1)
+    isSwapped = diff[np.arange(len(diff)), first] < 0
+    keys[isSwapped] = keys[isSwapped, ::-1]
+    if len(keys) == 0:
+        return edges, owners
+    _, inverse, counts = np.unique(keys.reshape(-1, 6), axis=0, return_inverse=True, return_counts=True)
+    isBoundary = (counts[inverse.reshape(-1)] == 1)
+
+    return edges[isBoundary], owners[isBoundary]
@@ -0,0 +1,114 @@
+import json
+import os
+import time
+import numpy as np
+from contextlib import contextmanager
+
+def Now():
+    """ Return wall time and CPU time of this process and its finished children """
+    return time.time(), sum(os.times()[:4])
+
+class Stats:
+    def __init__(self):
+        """ Opt-in run statistics: wall/CPU time per stage, exact facet tests
+            (CheckHit evaluations) per ray and hits per layer
+        """
+        self.stages = []
+        self.wall = {}
+        self.cpu = {}
+        self.nTests = 0
+        # Histogram of the number of exact facet tests (candidates) per ray
+        self.testHist = np.zeros(1, dtype=np.int64)
+        self.nRays = 0
+        self.layerHits = np.zeros(0, dtype=np.int64)
+        # Wall and CPU time of the stages nested in each active stage
+        self.nested = []
+
+    def AddTime(self, name, wall, cpu):
+        if name not in self.wall:
+            self.stages.append(name)
+            self.wall[name] = 0.
+            self.cpu[name] = 0.
+        self.wall[name] += wall
+        self.cpu[name] += cpu
+        return
+
+    def AddTests(self, nTests):
+        """ Add array of the number of exact facet tests of each ray """
+        nTests = np.asarray(nTests, dtype=np.int64)
+        self.nTests += int(nTests.sum())
+        counts = np.bincount(nTests)
+        if len(counts) > len(self.testHist):
+            self.testHist = np.append(self.testHist, np.zeros(len(counts)-len(self.testHist), dtype=np.int64))
+        self.testHist[:len(counts)] += counts
+        return
+
+    def AddHits(self, layerHits):
+        """ Add (nRays, nLayers) array of layer hits """
+        layerHits = np.asarray(layerHits, dtype=bool)
+        if len(self.layerHits) < layerHits.shape[1]:
+            self.layerHits = np.append(self.layerHits, np.zeros(layerHits.shape[1]-len(self.layerHits), dtype=np.int64))
+        self.nRays += len(layerHits)
+        self.layerHits[:layerHits.shape[1]] += np.count_nonzero(layerHits, axis=0)
+        return
+
+    def ToDict(self):
+        nTested = int(self.testHist.sum())
+        tests = np.arange(len(self.testHist))
+        return { "stages": [ {"name": name, "wall": self.wall[name], "cpu": self.cpu[name]} for name in self.stages ],
+                 "nTests": self.nTests,
+                 "testsPerRay": { "mean": float((tests*self.testHist).sum())/max(nTested, 1),
+                                  "max": int(tests[self.testHist > 0].max()) if nTested else 0,
+                                  "hist": self.testHist.tolist() },
+                 "nRays": self.nRays,
+                 "layerHitRate": [ float(n)/max(self.nRays, 1) for n in self.layerHits ] }
+
+    def ToJSON(self):
+        return json.dumps(self.ToDict(), sort_keys=True)
+
+    def Print(self):
+        stats = self.ToDict()
+        print("---------------- Stats ----------------")
+        for stage in stats["stages"]:
+            print("{0:<12} wall {1:>9.3f} s  cpu {2:>9.3f} s".format(stage["name"], stage["wall"], stage["cpu"]))
+        print("{0:<12} wall {1:>9.3f} s  cpu {2:>9.3f} s".format("total", sum(self.wall.values()), sum(self.cpu.values())))
+        print("{0} exact facet tests, {1:.1f} per ray (max {2})".format(
+              stats["nTests"], stats["testsPerRay"]["mean"], stats["testsPerRay"]["max"]))
+        for j, rate in enumerate(stats["layerHitRate"]):
+            print("Layer {0} hit rate: {1:.4f}".format(j, rate))
+        return
+
+@contextmanager
+def Stage(stats, name):
+    """ Time the enclosed block as stage name of stats (no-op if stats is
+        None), excluding the time of stages nested in it
+    """
+    if stats is None:
+        yield
+        return
+    stats.nested.append([0., 0.])
+    wall, cpu = Now()
+    try:
+        yield
+    finally:
+        endWall, endCPU = Now()
+        nestedWall, nestedCPU = stats.nested.pop()
+        stats.AddTime(name, endWall-wall-nestedWall, endCPU-cpu-nestedCPU)
+        if stats.nested:
+            stats.nested[-1][0] += endWall-wall
+            stats.nested[-1][1] += endCPU-cpu
+
+def TimeIter(stats, name, iterable):
+    """ Iterate, timing each step as stage name of stats (no-op if stats is None) """
+    if stats is None:
+        for item in iterable:
+            yield item
+        return
+    iterator = iter(iterable)
+    while True:
+        with Stage(stats, name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
@@ -1,10 +1,51 @@
-import ROOT
 import numpy as np
+import io
+import os
+import shutil
+import tempfile
+import zipfile
+
+# Scalar branches, in the order they are stored in OutTree._scalars
+SCALARS = [ "pdgID", "q", "m", "x", "y", "z", "angle", "px", "py", "pz", "pt", "eta", "phi", "nHits" ]
+# Minimum width of the per-layer branches, so that outputs of geometries
+# with fewer layers have the same schema (and can be chained)
+N_LAYER_BRANCHES = 4
+
+def PadLayers(values, width):
+    """ Pad (nRays, nLayers, ...) array of per-layer values with zeros to width layers """
+    values = np.asarray(values)
+    if values.shape[1] >= width:
+        return values
+    padding = np.zeros((len(values), width-values.shape[1])+values.shape[2:], dtype=values.dtype)
+    return np.concatenate((values, padding), axis=1)
+
+def GetScalars(rays, nHits):
+    """ Return (nRays, len(SCALARS)) array of scalar branch values of a block
+        of rays (structured array) and their number of hits
+    """
+    scalars = np.zeros((len(rays), len(SCALARS)), dtype=float)
+    scalars[:, 0] = rays["id"]
+    scalars[:, 1] = rays["charge"]
+    scalars[:, 2] = rays["mass"]
+    scalars[:, 3:6] = rays["pos"]
+    scalars[:, 6] = GetAngle(rays["p"])
+    scalars[:, 7:10] = rays["p"]
+    scalars[:, 10] = rays["pt"]
+    scalars[:, 11] = rays["eta"]
+    scalars[:, 12] = rays["phi"]
+    scalars[:, 13] = nHits
+    return scalars
 
 class OutTree:
-    def __init__(self):
+    def __init__(self, nLayers=4, weighted=False):
+        # Only load ROOT when writing a ROOT output
+        import ROOT
         self.tree = ROOT.TTree("Events","")
-        
+        self.nLayers = nLayers
+        # Layers beyond the geometry's are filled without hits
+        self.width = max(nLayers, N_LAYER_BRANCHES)
+        self.weighted = weighted
+
         self.pdgID = 0.
         self.q = 0.
         self.m = 0.
@@ -19,84 +60,154 @@ class OutTree:
         self.eta = 0.
         self.phi = 0.
         self.nHits = 0.
-        self.layerHits = np.zeros(4, dtype=bool)
-        self.layerHitPosX = np.zeros(4, dtype=float)
-        self.layerHitPosY = np.zeros(4, dtype=float)
-        self.layerHitPosZ = np.zeros(4, dtype=float)
-
-        self._pdgID = np.zeros(1, dtype=float)
-        self._q = np.zeros(1, dtype=float)
-        self._m = np.zeros(1, dtype=float)
-        self._x = np.zeros(1, dtype=float)
-        self._y = np.zeros(1, dtype=float)
-        self._z = np.zeros(1, dtype=float)
-        self._angle = np.zeros(1, dtype=float)
-        self._px = np.zeros(1, dtype=float)
-        self._py = np.zeros(1, dtype=float)
-        self._pz = np.zeros(1, dtype=float)
-        self._pt = np.zeros(1, dtype=float)
-        self._eta = np.zeros(1, dtype=float)
-        self._phi = np.zeros(1, dtype=float)
-        self._nHits = np.zeros(1, dtype=float)
-        self._layerHits = np.zeros(4, dtype=bool)
-        self._layerHitPosX = np.zeros(4, dtype=float)
-        self._layerHitPosY = np.zeros(4, dtype=float)
-        self._layerHitPosZ = np.zeros(4, dtype=float)
-
-        self.tree.Branch("pdgID",self._pdgID,"pdgID/D")
-        self.tree.Branch("q",self._q,"q/D")
-        self.tree.Branch("m",self._m,"m/D")
-        self.tree.Branch("x",self._x,"x/D")
-        self.tree.Branch("y",self._y,"y/D")
-        self.tree.Branch("z",self._z,"z/D")
-        self.tree.Branch("angle",self._angle,"angle/D")
-        self.tree.Branch("px",self._px,"px/D")
-        self.tree.Branch("py",self._py,"py/D")
-        self.tree.Branch("pz",self._pz,"pz/D")
-        self.tree.Branch("pt",self._pt,"pt/D")
-        self.tree.Branch("eta",self._eta,"eta/D")
-        self.tree.Branch("phi",self._phi,"phi/D")
-        self.tree.Branch("nHits",self._nHits,"nHits/D")
-        self.tree.Branch("layerHits",self._layerHits,"layerHits[4]/O")
-        self.tree.Branch("layerHitPosX",self._layerHitPosX,"layerHitPosX[4]/D")
-        self.tree.Branch("layerHitPosY",self._layerHitPosY,"layerHitPosY[4]/D")
-        self.tree.Branch("layerHitPosZ",self._layerHitPosZ,"layerHitPosZ[4]/D")
+        self.layerHits = np.zeros(self.width, dtype=bool)
+        self.layerHitPosX = np.zeros(self.width, dtype=float)
+        self.layerHitPosY = np.zeros(self.width, dtype=float)
+        self.layerHitPosZ = np.zeros(self.width, dtype=float)
+
+        # Branch buffers are views into a few contiguous arrays, so that a
+        # whole row can be copied in at once
+        self._scalars = np.zeros(len(SCALARS), dtype=float)
+        self._layerHits = np.zeros(self.width, dtype=bool)
+        self._layerHitPos = np.zeros((3, self.width), dtype=float)
+
+        for i, name in enumerate(SCALARS):
+            self.tree.Branch(name,self._scalars[i:i+1],"{}/D".format(name))
+        self.tree.Branch("layerHits",self._layerHits,"layerHits[{}]/O".format(self.width))
+        self.tree.Branch("layerHitPosX",self._layerHitPos[0],"layerHitPosX[{}]/D".format(self.width))
+        self.tree.Branch("layerHitPosY",self._layerHitPos[1],"layerHitPosY[{}]/D".format(self.width))
+        self.tree.Branch("layerHitPosZ",self._layerHitPos[2],"layerHitPosZ[{}]/D".format(self.width))
+        # Importance weight of rays with a "weight" field
+        self._weight = np.ones(1, dtype=float)
+        if weighted:
+            self.tree.Branch("weight",self._weight,"weight/D")
 
     def Fill(self):
-        
-        self._pdgID[0] = self.pdgID
-        self._q[0] = self.q
-        self._m[0] = self.m
-        self._x[0] = self.x
-        self._y[0] = self.y
-        self._z[0] = self.z
-        self._angle[0] = self.angle
-        self._px[0] = self.px
-        self._py[0] = self.py
-        self._pz[0] = self.pz
-        self._pt[0] = self.pt
-        self._eta[0] = self.eta
-        self._phi[0] = self.phi
-        self._nHits[0] = self.nHits
-        for l, val in enumerate(self.layerHits):
-            self._layerHits[l] = val
-        for i, x in enumerate(self.layerHitPosX):
-            self._layerHitPosX[i] = x
-        for j, y in enumerate(self.layerHitPosY):
-            self._layerHitPosY[j] = y
-        for k, z in enumerate(self.layerHitPosZ):
-            self._layerHitPosZ[k] = z
+
+        self._scalars[:] = [ getattr(self, name) for name in SCALARS ]
+        self._layerHits[:] = PadLayers([self.layerHits], self.width)[0]
+        self._layerHitPos[0] = PadLayers([self.layerHitPosX], self.width)[0]
+        self._layerHitPos[1] = PadLayers([self.layerHitPosY], self.width)[0]
+        self._layerHitPos[2] = PadLayers([self.layerHitPosZ], self.width)[0]
 
         self.tree.Fill()
 
+    def FillBlock(self, rays, nHits, layerHits, layerHitPos):
+        """ Fill tree with a block of rays (structured array), their number
+            of hits, (nRays, nLayers) layer hits and (nRays, nLayers, 3)
+            layer hit positions
+        """
+        # Build every row up front
+        scalars = GetScalars(rays, nHits)
+        layerHits = PadLayers(np.asarray(layerHits, dtype=bool), self.width)
+        layerHitPos = PadLayers(np.asarray(layerHitPos, dtype=float).reshape(len(rays), self.nLayers, 3), self.width)
+        layerHitPos = np.ascontiguousarray(np.transpose(layerHitPos, (0, 2, 1)))
+        weights = rays["weight"] if self.weighted else np.ones(len(rays))
+        # Copy rows into branch buffers
+        for i in range(len(rays)):
+            self._scalars[:] = scalars[i]
+            self._layerHits[:] = layerHits[i]
+            self._layerHitPos[:] = layerHitPos[i]
+            self._weight[0] = weights[i]
+            self.tree.Fill()
+
     def GetKinematics(self, rayObj):
         self.pdgID = rayObj["id"]
         self.q = rayObj["charge"]
         self.m = rayObj["mass"]
-        self.angle = np.arctan(rayObj["p"][2]/(rayObj["p"][0]**2 + rayObj["p"][1]**2)**(0.5))
+        self.angle = GetAngle(rayObj["p"])
         self.px = rayObj["p"][0]
         self.py = rayObj["p"][1]
         self.pz = rayObj["p"][2]
         self.pt = rayObj["pt"]
         self.eta = rayObj["eta"]
         self.phi = rayObj["phi"]
+
+class NpzTree:
+    def __init__(self, nLayers=4, weighted=False, tmpDir=None):
+        """ ROOT-free output with the same branches as OutTree, written as
+            one array per branch to an .npz file. Filled blocks are appended
+            to one raw file per branch in a temporary directory (in tmpDir if
+            given), so memory does not grow with the number of rays.
+        """
+        self.nLayers = nLayers
+        self.width = max(nLayers, N_LAYER_BRANCHES)
+        self.weighted = weighted
+        self.nEntries = 0
+        # (name, dtype, shape of one entry) of each branch
+        self.branches = [ (name, np.dtype(float), ()) for name in SCALARS ]
+        self.branches.append(("layerHits", np.dtype(bool), (self.width,)))
+        self.branches += [ ("layerHitPos"+axis, np.dtype(float), (self.width,)) for axis in "XYZ" ]
+        if weighted:
+            self.branches.append(("weight", np.dtype(float), ()))
+        self.spoolDir = tempfile.mkdtemp(prefix="npztree_", dir=tmpDir)
+
+    def GetSpoolPath(self, name):
+        return os.path.join(self.spoolDir, "{}.raw".format(name))
+
+    def FillBlock(self, rays, nHits, layerHits, layerHitPos):
+        """ Same as OutTree.FillBlock """
+        scalars = GetScalars(rays, nHits)
+        layerHitPos = PadLayers(np.asarray(layerHitPos, dtype=float).reshape(len(rays), self.nLayers, 3), self.width)
+        values = dict((name, scalars[:, i]) for i, name in enumerate(SCALARS))
+        values["layerHits"] = PadLayers(np.asarray(layerHits, dtype=bool), self.width)
+        for i, axis in enumerate("XYZ"):
+            values["layerHitPos"+axis] = layerHitPos[..., i]
+        if self.weighted:
+            values["weight"] = rays["weight"]
+        for name, dtype, shape in self.branches:
+            with open(self.GetSpoolPath(name), "ab") as fout:
+                fout.write(np.ascontiguousarray(values[name], dtype=dtype).tobytes())
+        self.nEntries += len(rays)
+
+    def GetArrays(self):
+        """ Return dict of branch name to array over all entries (in memory) """
+        arrays = {}
+        for name, dtype, shape in self.branches:
+            path = self.GetSpoolPath(name)
+            values = np.fromfile(path, dtype=dtype) if os.path.isfile(path) else np.zeros(0, dtype=dtype)
+            arrays[name] = values.reshape((self.nEntries,)+shape)
+        return arrays
+
+    def Write(self, outPath, metadata=None, extra=None):
+        """ Write branches (and JSON metadata string, extra dict of arrays if
+            given) to outPath, copying spooled branches without loading them,
+            and remove the spool directory
+        """
+        npyPath = os.path.join(self.spoolDir, "array.npy")
+        with zipfile.ZipFile(outPath, "w", zipfile.ZIP_STORED, allowZip64=True) as outZip:
+            for name, dtype, shape in self.branches:
+                with open(npyPath, "wb") as fout:
+                    header = {"descr": np.lib.format.dtype_to_descr(dtype), "fortran_order": False,
+                              "shape": (self.nEntries,)+shape}
+                    np.lib.format.write_array_header_1_0(fout, header)
+                    path = self.GetSpoolPath(name)
+                    if os.path.isfile(path):
+                        with open(path, "rb") as fin:
+                            shutil.copyfileobj(fin, fout)
+                outZip.write(npyPath, name+".npy")
+        shutil.rmtree(self.spoolDir)
+        AppendArrays(outPath, {} if extra is None else extra, metadata=metadata)
+        return
+
+def AppendArrays(outPath, arrays, metadata=None):
+    """ Add dict of (small) arrays, and JSON metadata string if given, to
+        the .npz file outPath
+    """
+    arrays = dict(arrays)
+    if metadata is not None:
+        arrays["Metadata"] = np.array(metadata)
+    if not arrays:
+        return
+    with zipfile.ZipFile(outPath, "a", zipfile.ZIP_STORED, allowZip64=True) as outZip:
+        for name, array in arrays.items():
+            fout = io.BytesIO()
+            np.save(fout, array)
+            outZip.writestr(name+".npy", fout.getvalue())
+    return
+
+def GetAngle(p):
+    """ Return angle of momentum (or (n, 3) array of momenta) w.r.t. transverse plane """
+    p = np.asarray(p, dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.arctan(p[..., 2]/(p[..., 0]**2 + p[..., 1]**2)**(0.5))
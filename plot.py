@@ -1,40 +1,378 @@
 import ROOT
 import os
+import json
+import numpy as np
+from glob import glob
 from subprocess import call
+from weights import WeightTable, WeightFunction
+from rootutils import AsArray, GetBins, GetBinning
+
+# TTree formulas read for each column
+FORMULAS = { "pt":           ["pt"],
+             "eta":          ["eta"],
+             "x":            ["x"],
+             "y":            ["y"],
+             "layerHits":    [ "layerHits[{}]".format(i) for i in range(4) ],
+             "layerHitPosX": [ "layerHitPosX[{}]".format(i) for i in range(4) ],
+             "layerHitPosY": [ "layerHitPosY[{}]".format(i) for i in range(4) ],
+             # Importance weight of oversampled outputs (converge.ParseConverged)
+             "importance":   ["weight"] }
+# Columns read for every histogram
+BASE_COLUMNS = ["pt", "eta", "x", "y", "layerHits"]
+# Columns kept in the analysis store, along with importance if any input has weights
+STORE_COLUMNS = ["pt", "eta", "x", "y", "layerHits", "layerHitPosX", "layerHitPosY"]
+# Loop of GetWeight over an array, declared once GetWeight.h is loaded
+GET_WEIGHT_ARRAY = """
+void GetWeightArray(const double* eta, double* weights, long n) {
+    for (long i = 0; i < n; i++) weights[i] = GetWeight(eta[i]);
+}
+"""
+
+def ReadFormulas(tree, formulas):
+    """ Evaluate list of TTree formulas for every entry with a single pass
+        over the tree, return list of arrays
+    """
+    tree.SetEstimate(tree.GetEntries()+1)
+    n = tree.Draw(":".join(formulas), "", "goff para")
+    if n < 0:
+        raise RuntimeError("Could not evaluate {}".format(", ".join(formulas)))
+    return [ np.array(AsArray(tree.GetVal(i), n)) for i in range(len(formulas)) ]
+
+def ReadTreeColumns(tree, names):
+    """ Read columns from a tree with a single pass, return dict of arrays """
+    formulas = sum([ FORMULAS[name] for name in names ], [])
+    values = ReadFormulas(tree, formulas)
+    columns = {}
+    for name in names:
+        nValues = len(FORMULAS[name])
+        column = np.stack(values[:nValues], axis=1) if nValues > 1 else values[0]
+        columns[name] = (column != 0) if name == "layerHits" else column
+        values = values[nValues:]
+    return columns
+
+def HasImportance(tree):
+    """ Return whether an Events tree has importance weights ("weight" branch) """
+    return bool(tree.GetBranch("weight"))
+
+def GetInputs(inPaths):
+    """ Return path, size and modification time of each input file """
+    return [ {"path": os.path.abspath(inPath),
+              "size": os.path.getsize(inPath),
+              "mtime": os.path.getmtime(inPath)} for inPath in sorted(inPaths) ]
+
+def BuildStore(inPaths, storeDir, verbose=False):
+    """ Merge Events trees of output files into one .npy file per column in
+        storeDir, with a manifest of the input files
+    """
+    inputs = GetInputs(inPaths)
+    if not os.path.isdir(storeDir): os.makedirs(storeDir)
+    # Remove manifest first so that a partially built store is never used
+    manifestPath = os.path.join(storeDir, "manifest.json")
+    if os.path.isfile(manifestPath): os.remove(manifestPath)
+    # Count entries so that the columns can be written in place
+    nEntries = []
+    isWeighted = []
+    for inFile in inputs:
+        tFile = ROOT.TFile.Open(inFile["path"])
+        nEntries.append(int(tFile.Get("Events").GetEntries()))
+        isWeighted.append(HasImportance(tFile.Get("Events")))
+        tFile.Close()
+    names = STORE_COLUMNS+(["importance"] if any(isWeighted) else [])
+    columns = {}
+    for name in names:
+        shape = (sum(nEntries),) if len(FORMULAS[name]) == 1 else (sum(nEntries), len(FORMULAS[name]))
+        columns[name] = np.lib.format.open_memmap(os.path.join(storeDir, "{}.npy".format(name)), mode="w+",
+                                                  dtype=(bool if name == "layerHits" else np.float64), shape=shape)
+    start = 0
+    for inFile, n, weighted in zip(inputs, nEntries, isWeighted):
+        tFile = ROOT.TFile.Open(inFile["path"])
+        for name, column in ReadTreeColumns(tFile.Get("Events"), names if weighted else STORE_COLUMNS).items():
+            columns[name][start:start+n] = column
+        # Unweighted entries count once
+        if "importance" in names and not weighted:
+            columns["importance"][start:start+n] = 1.
+        tFile.Close()
+        start += n
+    for column in columns.values():
+        column.flush()
+    with open(manifestPath, "w") as fout:
+        json.dump({"inputs": inputs, "nEntries": sum(nEntries), "columns": names}, fout, indent=4)
+    if verbose: print("Built store of {0} entries from {1} files in {2}".format(sum(nEntries), len(inputs), storeDir))
+
+    return
+
+def LoadStore(inPaths, storeDir, verbose=False):
+    """ Return memory-mapped columns of the store in storeDir, (re)building it
+        if the input files were added, removed or modified since it was built,
+        or if it was built before the stored columns were recorded
+    """
+    manifestPath = os.path.join(storeDir, "manifest.json")
+    manifest = {}
+    if os.path.isfile(manifestPath):
+        with open(manifestPath, "r") as fin:
+            manifest = json.load(fin)
+    if manifest.get("inputs") != GetInputs(inPaths) or "columns" not in manifest:
+        BuildStore(inPaths, storeDir, verbose=verbose)
+        with open(manifestPath, "r") as fin:
+            manifest = json.load(fin)
+    elif verbose:
+        print("Using store in {}".format(storeDir))
+
+    return dict((name, np.load(os.path.join(storeDir, "{}.npy".format(name)), mmap_mode="r"))
+                for name in manifest["columns"])
+
+def FillHist(hist, values, weights=None):
+    """ Fill TH1D/TH2D from a list of one or two arrays of values """
+    # Global ROOT bin index, including under/overflow bins
+    globalBin = GetBins(values, GetBinning(hist, len(values)))
+    isValid = (globalBin >= 0)
+    globalBin = globalBin[isValid]
+    if weights is not None:
+        weights = np.asarray(weights, dtype=float)[isValid]
+        hist.Sumw2()
+        sumw2 = AsArray(hist.GetSumw2().GetArray(), hist.GetNcells())
+        sumw2 += np.bincount(globalBin, weights=weights**2, minlength=hist.GetNcells())
+    contents = AsArray(hist.GetArray(), hist.GetNcells())
+    contents += np.bincount(globalBin, weights=weights, minlength=hist.GetNcells())
+    hist.SetEntries(hist.GetEntries()+len(globalBin))
+    return
+
+class GetWeights:
+    def __init__(self):
+        """ Exact eta weights of GetWeight.h, evaluated for a whole array in
+            one compiled call
+        """
+        ROOT.gROOT.ProcessLine(".L GetWeight.h")
+        if not hasattr(ROOT, "GetWeightArray"):
+            ROOT.gInterpreter.Declare(GET_WEIGHT_ARRAY)
+
+    def __call__(self, x):
+        """ Return weights of an array of values """
+        values = np.ascontiguousarray(x, dtype=np.float64).reshape(-1)
+        weights = np.zeros(len(values))
+        if len(values):
+            ROOT.GetWeightArray(values, weights, len(values))
+        return weights.reshape(np.shape(x))
 
 class ChronoPlots:
     def __init__(self, inPath="", outDir="", 
-                       endcapOuterRad=1.27, endcapInnerRad=0.315):
+                       endcapOuterRad=1.27, endcapInnerRad=0.315, weights=None, storeDir=None,
+                       weightTableBins=None):
         self.tChain = ROOT.TChain("Events")
+        self.inPaths = []
         self.outDir = outDir 
         self.LoadFile(inPath)
+        # Columnar store of the input files, read instead of the chain if set
+        self.storeDir = storeDir
         self.endcapOuterRad = endcapOuterRad
         self.endcapInnerRad = endcapInnerRad
+        # Eta weights: WeightTable, path to a weight table file or function of eta
+        self.weights = weights
+        # Approximate functions by a table of this many bins in |eta| <= 5 if set
+        self.weightTableBins = weightTableBins
+        # Whether the inputs carry importance weights, checked once
+        self.isImportance = None
+        # Columns read from the chain, declared and filled histograms
+        self.columns = {}
+        self.hists = {}
+        self.booked = []
+        # Endcap disk masks keyed by (binning, radii)
+        self.annulusMasks = {}
+        # Denominator selections keyed by (pt cut, radii)
+        self.selections = {}
 
     def LoadFile(self, inPath):
-        if inPath.split(".")[-1] == "root" and os.path.isfile(inPath):
-            self.tChain.Add(inPath)
+        """ Add .root file, or every .root file matching a glob, to the chain """
+        for path in sorted(glob(inPath)):
+            if path.split(".")[-1] == "root" and os.path.isfile(path):
+                self.tChain.Add(path)
+                self.inPaths.append(path)
+        return
+
+    def IsImportanceWeighted(self):
+        """ Return whether the inputs carry importance weights (outputs of
+            converge.ParseConverged with oversampling), by which every
+            histogram and efficiency is then weighted
+        """
+        if self.isImportance is None:
+            isWeighted = []
+            for path in self.inPaths:
+                tFile = ROOT.TFile.Open(path)
+                isWeighted.append(HasImportance(tFile.Get("Events")))
+                tFile.Close()
+            if any(isWeighted) and not all(isWeighted) and self.storeDir is None:
+                raise ValueError("Cannot chain importance-weighted and unweighted outputs without a store")
+            self.isImportance = any(isWeighted)
+        return self.isImportance
+
+    def GetWeightTable(self):
+        """ Return eta weight lookup, GetWeight.h evaluated exactly in one
+            compiled call per array by default, or tabulated with
+            weightTableBins bins if set
+        """
+        if isinstance(self.weights, (WeightTable, WeightFunction, GetWeights)):
+            return self.weights
+        if self.weights is None:
+            self.weights = GetWeights()
+            if self.weightTableBins is None:
+                return self.weights
+            self.weights = ROOT.GetWeight
+        if not callable(self.weights):
+            self.weights = WeightTable.FromFile(self.weights)
+        elif self.weightTableBins is not None:
+            self.weights = WeightTable.FromFunction(self.weights, nBins=self.weightTableBins)
+        else:
+            self.weights = WeightFunction(self.weights)
+        return self.weights
+
+    def ReadColumns(self, names):
+        """ Read any missing columns from the store, or from the chain in a
+            single pass
+        """
+        if self.storeDir is not None and "pt" not in self.columns:
+            self.columns.update(LoadStore(self.inPaths, self.storeDir))
+        missing = [ name for name in names if name not in self.columns ]
+        if "weight" in missing:
+            # Per-event weights are looked up once from eta, times the
+            # importance weights if any
+            missing.remove("weight")
+            isImportance = self.IsImportanceWeighted()
+            self.ReadColumns(missing+["eta"]+(["importance"] if isImportance else []))
+            self.columns["weight"] = self.GetWeightTable()(self.columns["eta"])
+            if isImportance:
+                self.columns["weight"] = self.columns["weight"]*self.columns["importance"]
+            return
+        if not missing: return
+        self.columns.update(ReadTreeColumns(self.tChain, missing))
+        return
+
+    def Book(self, name, title, binning, variables, selection=None, columns=[], weighted=False):
+        """ Declare TH1D (3 binning args) or TH2D (6 binning args) filled with
+            variables (functions of the columns dict) of the entries passing
+            selection, using extra columns beyond BASE_COLUMNS
+        """
+        if name in self.hists: return self.hists[name]
+        if len(binning) == 3:
+            hist = ROOT.TH1D(name, title, *binning)
+        else:
+            hist = ROOT.TH2D(name, title, *binning)
+        self.hists[name] = hist
+        columns = BASE_COLUMNS+list(columns)+(["weight"] if weighted else [])
+        self.booked.append((hist, variables, selection, columns, weighted))
+        return hist
+
+    def Fill(self):
+        """ Fill every declared histogram with a single pass over the chain,
+            weighted by the importance weights of the inputs if any
+        """
+        if not self.booked: return
+        isImportance = self.IsImportanceWeighted()
+        self.ReadColumns(set(sum([ columns for _, _, _, columns, _ in self.booked ],
+                                 ["importance"] if isImportance else [])))
+        c = self.columns
+        for hist, variables, selection, columns, weighted in self.booked:
+            mask = selection(c) if selection else np.ones(len(c["pt"]), dtype=bool)
+            if weighted:
+                weights = c["weight"][mask]
+            else:
+                weights = c["importance"][mask] if isImportance else None
+            FillHist(hist, [ variable(c)[mask] for variable in variables ], weights=weights)
+        self.booked = []
+        return
+
+    def Denominator(self, ptCut=0.5):
+        """ Return mask of entries with pt > ptCut inside the endcap annulus,
+            evaluated once per dataset and selection parameters
+        """
+        key = (ptCut, self.endcapOuterRad, self.endcapInnerRad)
+        if key not in self.selections:
+            self.ReadColumns(BASE_COLUMNS)
+            c = self.columns
+            r = (c["x"]*c["x"]+c["y"]*c["y"])**0.5
+            self.selections[key] = (c["pt"] > ptCut) & (r < self.endcapOuterRad) & (r > self.endcapInnerRad)
+        return self.selections[key]
+
+    def Efficiency(self, numerator, ptCut=0.5, weighted=False):
+        """ Return (eta-weighted) fraction of denominator entries also passing
+            numerator mask, with the importance weights of the inputs if any
+        """
+        denominator = self.Denominator(ptCut)
+        if not weighted and not self.IsImportanceWeighted():
+            return float(np.count_nonzero(numerator & denominator))/float(np.count_nonzero(denominator))
+        name = "weight" if weighted else "importance"
+        self.ReadColumns([name])
+        weight = self.columns[name]
+        return weight[numerator & denominator].sum()/weight[denominator].sum()
+
+    def EffTable(self, ptCut=0.5, weighted=False):
+        """ Return efficiencies of each layer, each pair of consecutive layers
+            (OR) and of the two disks (OR AND OR)
+        """
+        self.ReadColumns(BASE_COLUMNS)
+        layerHits = self.columns["layerHits"]
+        table = {}
+        for i in range(layerHits.shape[1]):
+            table["Layer {}".format(i)] = self.Efficiency(layerHits[:, i], ptCut, weighted)
+            if i+1 < layerHits.shape[1]:
+                table["Layer {0} OR {1}".format(i, i+1)] = self.Efficiency(self.LayerOr(i)(self.columns), ptCut, weighted)
+        table["Layer 0 OR 1 AND 2 OR 3"] = self.Efficiency(self.LayerOr(0)(self.columns) & self.LayerOr(2)(self.columns),
+                                                          ptCut, weighted)
+        return table
+
+    def AnnulusMask(self, hist):
+        """ Return mask over all cells of a TH2 whose bin centers are inside the
+            endcap disk, computed once per binning and radii
+        """
+        xAxis = hist.GetXaxis()
+        yAxis = hist.GetYaxis()
+        key = (xAxis.GetNbins(), xAxis.GetXmin(), xAxis.GetXmax(),
+               yAxis.GetNbins(), yAxis.GetXmin(), yAxis.GetXmax(),
+               self.endcapOuterRad, self.endcapInnerRad)
+        if key in self.annulusMasks:
+            return self.annulusMasks[key]
+        # Absolute bin centers, with under/overflow cells left out of the mask
+        x = np.abs(np.linspace(xAxis.GetXmin(), xAxis.GetXmax(), 2*xAxis.GetNbins()+1)[1::2])
+        y = np.abs(np.linspace(yAxis.GetXmin(), yAxis.GetXmax(), 2*yAxis.GetNbins()+1)[1::2])
+        x, y = np.meshgrid(x, y)
+        with np.errstate(invalid="ignore"):
+            yMax = (self.endcapOuterRad**(2)-x**(2))**(0.5)
+            xMax = (self.endcapOuterRad**(2)-y**(2))**(0.5)
+            yMin = np.where(x <= self.endcapInnerRad, (self.endcapInnerRad**(2)-x**(2))**(0.5), -yMax)
+            xMin = np.where(y <= self.endcapInnerRad, (self.endcapInnerRad**(2)-y**(2))**(0.5), -xMax)
+            isInside = ((x < self.endcapOuterRad) & (y < self.endcapOuterRad)
+                        & (xMin < x) & (x < xMax) & (yMin < y) & (y < yMax))
+        mask = np.zeros((yAxis.GetNbins()+2, xAxis.GetNbins()+2), dtype=bool)
+        mask[1:-1, 1:-1] = isInside
+        self.annulusMasks[key] = mask.reshape(-1)
+
+        return self.annulusMasks[key]
+
+    def FillDiskEdges(self, hist, value=0.01):
+        """ Set empty bins of a TH2 inside the endcap disk to value """
+        contents = AsArray(hist.GetArray(), hist.GetNcells())
+        contents[(contents == 0) & self.AnnulusMask(hist)] = value
+        return
+
+    def BookOverallEff(self, nLayer):
+        """ Declare weighted hit and all histograms of OverallEff """
+        # Number of Hits
+        self.Book("nHits"+str(nLayer), "", (1, 0, 2), [lambda c: np.ones(len(c["pt"]))],
+                  lambda c: self.Denominator() & self.LayerOr(nLayer)(c), weighted=True)
+        # All hits
+        self.Book("nAll", "", (1, 0, 2), [lambda c: np.ones(len(c["pt"]))],
+                  lambda c: self.Denominator(), weighted=True)
         return
 
     def OverallEff(self, nLayer):
         if nLayer >= 3:
             print("Please enter a layer below layer 3.")
             return
-        # Load Weights
-        ROOT.gROOT.ProcessLine(".L GetWeight.h")
+        self.BookOverallEff(nLayer)
+        self.Fill()
         # Setup canvas
         c = ROOT.TCanvas("c", "c", 400, 400) 
-        # nHits = self.tChain.GetEntries("pt > 0.5 && pow(x*x+y*y, 0.5) < {0} && pow(x*x+y*y, 0.5) > {1} && (layerHits[{2}] == 1 || layerHits[{3}] == 1)".format(self.endcapOuterRad, self.endcapInnerRad, nLayer, nLayer+1))
-        # nAll = self.tChain.GetEntries("pt > 0.5 && pow(x*x+y*y, 0.5) < {0} && pow(x*x+y*y, 0.5) > {1}".format(self.endcapOuterRad, self.endcapInnerRad))
-        # return round(float(nHits)/float(nAll), 2)
-        # Number of Hits
-        nHits = ROOT.TH1D("nHits", "", 1, 0, 2)
-        nHitsSelect = "(pt > 0.5 && pow(x*x+y*y, 0.5) < {0} && pow(x*x+y*y, 0.5) > {1} && (layerHits[{2}] == 1 || layerHits[{3}] == 1))*GetWeight(eta)".format(self.endcapOuterRad, self.endcapInnerRad, nLayer, nLayer+1)
-        self.tChain.Draw("1 >> nHits", nHitsSelect, "")
-        # All hits
-        nAll = ROOT.TH1D("nAll", "", 1, 0, 2)
-        nAllSelect = "(pt > 0.5 && pow(x*x+y*y, 0.5) < {0} && pow(x*x+y*y, 0.5) > {1})*GetWeight(eta)".format(self.endcapOuterRad, self.endcapInnerRad)
-        self.tChain.Draw("1 >> nAll", nAllSelect, "")
+        nHits = self.hists["nHits"+str(nLayer)].Clone("nHitsEff"+str(nLayer))
+        nAll = self.hists["nAll"]
         # Divide
         nHits.Divide(nAll)
         nHits.Draw()
@@ -42,14 +380,23 @@ class ChronoPlots:
         return round(nHits.GetBinContent(1), 3)
 
     def TwoDiskOverallEff(self):
-        nHits = self.tChain.GetEntries("pt > 0.5 && pow(x*x+y*y, 0.5) < {0} && pow(x*x+y*y, 0.5) > {1} && ((layerHits[0]==1 || layerHits[1]==1) && (layerHits[2]==1 || layerHits[3]==1))".format(self.endcapOuterRad, self.endcapInnerRad))
-        nAll = self.tChain.GetEntries("pt > 0.5 && pow(x*x+y*y, 0.5) < {0} && pow(x*x+y*y, 0.5) > {1}".format(self.endcapOuterRad, self.endcapInnerRad))
-        return round(float(nHits)/float(nAll), 2)
+        self.ReadColumns(BASE_COLUMNS)
+        c = self.columns
+        return round(self.Efficiency(self.LayerOr(0)(c) & self.LayerOr(2)(c)), 2)
+
+    def BookLayerHits(self, nLayer):
+        """ Declare hit position histogram of LayerHits """
+        self.Book("layerhits"+str(nLayer), "Layer {} Hits".format(nLayer), (520,-1.30,1.30,520,-1.30,1.30),
+                  [lambda c: c["layerHitPosX"][:, nLayer], lambda c: c["layerHitPosY"][:, nLayer]],
+                  lambda c: c["layerHits"][:, nLayer], columns=["layerHitPosX", "layerHitPosY"])
+        return
 
     def LayerHits(self, nLayer):
         if nLayer > 3:
             print("Please enter the index of an existing layer.")
             return
+        self.BookLayerHits(nLayer)
+        self.Fill()
         # Setup canvas
         c0 = ROOT.TCanvas("c0", "c0", 400, 400) 
         ROOT.gStyle.SetOptStat(0)
@@ -57,16 +404,28 @@ class ChronoPlots:
         nLayer = str(nLayer)
 
         # Layer hits
-        layerPlot = ROOT.TH2D("layerhits"+nLayer, "Layer {} Hits".format(nLayer), 520,-1.30,1.30,520,-1.30,1.30)
-        self.tChain.Draw("layerHitPosY["+nLayer+"]:layerHitPosX["+nLayer+"]>>layerhits"+nLayer,
-                         "layerHits["+nLayer+"]==1", "colz")
+        layerPlot = self.hists["layerhits"+nLayer]
+        layerPlot.Draw("colz")
 
         c0.SaveAs("{0}/{1}.pdf".format(self.outDir, "LayerHits"+nLayer))
 
+    def LayerOr(self, nLayer):
+        """ Return function selecting entries with hits in layer nLayer or nLayer+1 """
+        return lambda c: c["layerHits"][:, nLayer] | c["layerHits"][:, nLayer+1]
+
+    def BookTwoLayerHits(self, nLayer):
+        """ Declare position histogram of TwoLayerHits """
+        plotID = str(nLayer)+str(nLayer+1)
+        self.Book("layerhits"+plotID, "Layer {0} OR {1} Hits".format(nLayer, nLayer+1), (520,-1.30,1.30,520,-1.3,1.3),
+                  [lambda c: c["x"], lambda c: c["y"]], self.LayerOr(nLayer))
+        return
+
     def TwoLayerHits(self, nLayer):
         if nLayer >= 3:
             print("Please enter a layer below layer 3.")
             return
+        self.BookTwoLayerHits(nLayer)
+        self.Fill()
         # Setup canvas
         c1 = ROOT.TCanvas("c1", "c1", 400, 400) 
         ROOT.gStyle.SetOptStat(0)
@@ -76,17 +435,29 @@ class ChronoPlots:
         plotID = nLayer1+nLayer2
 
         # Layer hits
-        twoLayerPlot = ROOT.TH2D("layerhits"+plotID, "Layer {0} OR {1} Hits".format(nLayer1, nLayer2), 520,-1.30,1.30,520,-1.3,1.3)
-        self.tChain.Draw("y:x>>layerhits"+plotID,
-                         "layerHits["+nLayer1+"]==1 || layerHits["+nLayer2+"]==1", "colz")
+        twoLayerPlot = self.hists["layerhits"+plotID]
+        twoLayerPlot.Draw("colz")
 
         c1.SaveAs("{0}/{1}.pdf".format(self.outDir, "LayerHits"+plotID))
         return
 
+    def BookLayerHitEff(self, nLayer):
+        """ Declare hit and all position histograms of LayerHitEff """
+        plotID = str(nLayer)+str(nLayer+1)
+        title = "Layer {0} OR {1} Hit Efficiency".format(nLayer, nLayer+1)
+        self.Book("hitpos"+plotID, title, (520,-1.30,1.30,520,-1.3,1.3),
+                  [lambda c: c["x"], lambda c: c["y"]], self.LayerOr(nLayer))
+        self.Book("allpos"+plotID, title, (520,-1.30,1.30,520,-1.3,1.3),
+                  [lambda c: c["x"], lambda c: c["y"]])
+        self.BookOverallEff(nLayer)
+        return
+
     def LayerHitEff(self, nLayer):
         if nLayer >= 3:
             print("Please enter a layer below layer 3.")
             return
+        self.BookLayerHitEff(nLayer)
+        self.Fill()
         # Setup canvas
         c2 = ROOT.TCanvas("c2", "c2", 400, 400) 
         ROOT.gStyle.SetOptStat(0)
@@ -96,31 +467,11 @@ class ChronoPlots:
         plotID = nLayer1+nLayer2
 
         # Layer hits
-        hitPosPlot = ROOT.TH2D("hitpos"+plotID, "Layer {0} OR {1} Hit Efficiency".format(nLayer1, nLayer2), 520,-1.30,1.30,520,-1.3,1.3)
-        self.tChain.Draw("y:x>>hitpos"+plotID,
-                         "layerHits["+nLayer1+"]==1 || layerHits["+nLayer2+"]==1", "colz")
+        hitPosPlot = self.hists["hitpos"+plotID].Clone("hitposeff"+plotID)
         # Fill edges of disk so that they show up in plot
-        for xBin in range(1, hitPosPlot.GetNbinsX()+1):
-            for yBin in range(1, hitPosPlot.GetNbinsY()+1):
-                val = hitPosPlot.GetBinContent(xBin,yBin)
-                x = abs(hitPosPlot.GetXaxis().GetBinCenter(xBin))
-                y = abs(hitPosPlot.GetYaxis().GetBinCenter(yBin))
-                if val == 0 and x < self.endcapOuterRad and y < self.endcapOuterRad:
-                    yMax = (self.endcapOuterRad**(2)-x**(2))**(0.5)
-                    xMax = (self.endcapOuterRad**(2)-y**(2))**(0.5)
-                    if x <= self.endcapInnerRad:
-                        yMin = (self.endcapInnerRad**(2)-x**(2))**(0.5)
-                    else:
-                        yMin = -yMax
-                    if y <= self.endcapInnerRad:
-                        xMin = (self.endcapInnerRad**(2)-y**(2))**(0.5)
-                    else:
-                        xMin = -xMax
-                    if xMin < x and x < xMax and yMin < y and y < yMax:
-                        hitPosPlot.SetBinContent(xBin, yBin,0.01)
+        self.FillDiskEdges(hitPosPlot)
         # Layer hits
-        allPosPlot = ROOT.TH2D("allpos"+plotID, "Layer {0} OR {1} Hit Efficiency".format(nLayer1, nLayer2), 520,-1.30,1.30,520,-1.3,1.3)
-        self.tChain.Draw("y:x>>allpos"+plotID, "", "colz")
+        allPosPlot = self.hists["allpos"+plotID]
         # Divide hit positions by all positions
         hitPosPlot.Divide(allPosPlot)
         hitPosPlot.Draw("colz")
@@ -134,38 +485,29 @@ class ChronoPlots:
         c2.SaveAs("{0}/{1}.pdf".format(self.outDir, "LayerHitEff"+plotID))
         return
 
+    def BookTwoDiskHitEff(self):
+        """ Declare hit and all position histograms of TwoDiskHitEff """
+        title = "Layer 0 OR 1 AND 2 OR 3 Hit Efficiency"
+        self.Book("diskhits", title, (520,-1.30,1.30,520,-1.3,1.3),
+                  [lambda c: c["x"], lambda c: c["y"]], lambda c: self.LayerOr(0)(c) & self.LayerOr(2)(c))
+        self.Book("allpos", title, (520,-1.30,1.30,520,-1.3,1.3),
+                  [lambda c: c["x"], lambda c: c["y"]])
+        return
+
     def TwoDiskHitEff(self):
+        self.BookTwoDiskHitEff()
+        self.Fill()
         # Setup canvas
         c3 = ROOT.TCanvas("c3", "c3", 400, 400) 
         ROOT.gStyle.SetOptStat(0)
         ROOT.gStyle.SetNumberContours(255)
 
         # Layer hits
-        diskHitPosPlot = ROOT.TH2D("diskhits", "Layer 0 OR 1 AND 2 OR 3 Hit Efficiency", 520,-1.30,1.30,520,-1.3,1.3)
-        self.tChain.Draw("y:x>>diskhits",
-                         "(layerHits[0]==1 || layerHits[1]==1) && (layerHits[2]==1 || layerHits[3]==1)", "colz")
+        diskHitPosPlot = self.hists["diskhits"].Clone("diskhitseff")
         # Fill edges of disk so that they show up in plot
-        for xBin in range(1, diskHitPosPlot.GetNbinsX()+1):
-            for yBin in range(1, diskHitPosPlot.GetNbinsY()+1):
-                val = diskHitPosPlot.GetBinContent(xBin,yBin)
-                x = abs(diskHitPosPlot.GetXaxis().GetBinCenter(xBin))
-                y = abs(diskHitPosPlot.GetYaxis().GetBinCenter(yBin))
-                if val == 0 and x < self.endcapOuterRad and y < self.endcapOuterRad:
-                    yMax = (self.endcapOuterRad**(2)-x**(2))**(0.5)
-                    xMax = (self.endcapOuterRad**(2)-y**(2))**(0.5)
-                    if x <= self.endcapInnerRad:
-                        yMin = (self.endcapInnerRad**(2)-x**(2))**(0.5)
-                    else:
-                        yMin = -yMax
-                    if y <= self.endcapInnerRad:
-                        xMin = (self.endcapInnerRad**(2)-y**(2))**(0.5)
-                    else:
-                        xMin = -xMax
-                    if xMin < x and x < xMax and yMin < y and y < yMax:
-                        diskHitPosPlot.SetBinContent(xBin, yBin,0.01)
+        self.FillDiskEdges(diskHitPosPlot)
         # Layer hits
-        allPosPlot = ROOT.TH2D("allpos", "Layer 0 OR 1 AND 2 OR 3 Hit Efficiency", 520,-1.30,1.30,520,-1.3,1.3)
-        self.tChain.Draw("y:x>>allpos", "", "colz")
+        allPosPlot = self.hists["allpos"]
         # Divide hit positions by all positions
         diskHitPosPlot.Divide(allPosPlot)
         diskHitPosPlot.Draw("colz")
@@ -179,10 +521,28 @@ class ChronoPlots:
         c3.SaveAs("{0}/TwoDiskHitEff.pdf".format(self.outDir))
         return
 
+    def BookLayerEtaEff(self, nLayer, highEta=False):
+        """ Declare hit and all eta histograms of LayerEtaEff """
+        plotID = str(nLayer)+str(nLayer+1)
+        title = "Layer {0} OR {1} Eta Efficiency".format(nLayer, nLayer+1)
+        if highEta:
+            binning = (180,1.57,2.85)
+            allSelect = lambda c: (c["pt"] > 0.5) & (c["eta"] > 1.4) & (c["eta"] < 2.9)
+            plotID += "HighEta"
+        else:
+            binning = (180,1.2,3.0)
+            allSelect = lambda c: (c["pt"] > 0.5)
+        self.Book("hiteta"+plotID, title, binning, [lambda c: c["eta"]],
+                  lambda c: self.LayerOr(nLayer)(c) & allSelect(c))
+        self.Book("alleta"+plotID, title, binning, [lambda c: c["eta"]], allSelect)
+        return
+
     def LayerEtaEff(self, nLayer, highEta=False):
         if nLayer >= 3:
             print("Please enter a layer below layer 3.")
             return
+        self.BookLayerEtaEff(nLayer, highEta=highEta)
+        self.Fill()
         # Setup canvas
         c4 = ROOT.TCanvas("c4", "c4", 400, 400) 
         ROOT.gStyle.SetOptStat(0)
@@ -192,24 +552,13 @@ class ChronoPlots:
         plotID = nLayer1+nLayer2
 
         # Layer hits eta
-        highEtaArg = ""
-        highEtaTag = ""
-        lowerEtaBound = 1.2
-        upperEtaBound = 3.0
-        if highEta:
-            highEtaArg = " && eta > 1.4 && eta < 2.9"
-            highEtaTag = "HighEta"
-            lowerEtaBound = 1.57
-            upperEtaBound = 2.85
-        hitEtaPlot = ROOT.TH1D("hiteta"+plotID, "Layer {0} OR {1} Eta Efficiency".format(nLayer1, nLayer2), 180,lowerEtaBound,upperEtaBound)
-        self.tChain.Draw("eta>>hiteta"+plotID,
-                         "(layerHits["+nLayer1+"]==1 || layerHits["+nLayer2+"]==1) && pt > 0.5"+highEtaArg, "")
+        highEtaTag = "HighEta" if highEta else ""
+        hitEtaPlot = self.hists["hiteta"+plotID+highEtaTag]
 
         # All eta
-        allEtaPlot = ROOT.TH1D("alleta"+plotID, "Layer {0} OR {1} Eta Efficiency".format(nLayer1, nLayer2), 180,lowerEtaBound,upperEtaBound)
-        self.tChain.Draw("eta>>alleta"+plotID, "pt > 0.5"+highEtaArg, "")
+        allEtaPlot = self.hists["alleta"+plotID+highEtaTag]
         # Base plot for formatting
-        baseEtaPlot = hitEtaPlot.Clone("baseeta"+plotID)
+        baseEtaPlot = hitEtaPlot.Clone("baseeta"+plotID+highEtaTag)
         baseEtaPlot.Reset()
         if highEta:
             baseEtaPlot.GetYaxis().SetRangeUser(0.90, 1.00)
@@ -225,10 +574,22 @@ class ChronoPlots:
         c4.SaveAs("{0}/{1}.pdf".format(self.outDir, "LayerEtaEff"+plotID+highEtaTag))
         return
 
+    def BookLayerEtaPtEff(self, nLayer):
+        """ Declare hit and all eta/pt histograms of LayerEtaPtEff """
+        plotID = str(nLayer)+str(nLayer+1)
+        title = "Layer {0} OR {1} Eta/pt Efficiency".format(nLayer, nLayer+1)
+        self.Book("hitetapt"+plotID, title, (200,0,10,180,1.2,3.0),
+                  [lambda c: c["pt"], lambda c: c["eta"]], self.LayerOr(nLayer))
+        self.Book("alletapt"+plotID, title, (200,0,10,180,1.2,3.0),
+                  [lambda c: c["pt"], lambda c: c["eta"]])
+        return
+
     def LayerEtaPtEff(self, nLayer):
         if nLayer >= 3:
             print("Please enter a layer below layer 3.")
             return
+        self.BookLayerEtaPtEff(nLayer)
+        self.Fill()
         # Setup canvas
         c5 = ROOT.TCanvas("c5", "c5", 400, 400) 
         ROOT.gStyle.SetOptStat(0)
@@ -238,13 +599,9 @@ class ChronoPlots:
         plotID = nLayer1+nLayer2
 
         # Layer hits eta/pt
-        hitEtaPtPlot = ROOT.TH2D("hitetapt"+plotID, "Layer {0} OR {1} Eta/pt Efficiency".format(nLayer1, nLayer2), 200,0,10,180,1.2,3.0)
-        self.tChain.Draw("eta:pt>>hitetapt"+plotID,
-                         "layerHits["+nLayer1+"]==1 || layerHits["+nLayer2+"]==1", "")
+        hitEtaPtPlot = self.hists["hitetapt"+plotID].Clone("hitetapteff"+plotID)
         # All eta/pt
-        allEtaPtPlot = ROOT.TH2D("alletapt"+plotID, "Layer {0} OR {1} Eta/pt Efficiency".format(nLayer1, nLayer2), 200,0,10,180,1.2,3.0)
-        self.tChain.Draw("eta:pt>>alletapt"+plotID,
-                         "", "")
+        allEtaPtPlot = self.hists["alletapt"+plotID]
 
         # Divide hit positions by all positions
         hitEtaPtPlot.Divide(allEtaPtPlot)
@@ -256,13 +613,19 @@ class ChronoPlots:
         c5.SaveAs("{0}/{1}.pdf".format(self.outDir, "LayerEtaPtEff"+plotID))
         return
 
-def Plot(inPath, outDir, verbose=False):
+def Plot(inPath, outDir, verbose=False, weights=None, storeDir=None, weightTableBins=None):
     if not os.path.isdir(outDir): os.mkdir(outDir)
     # Start plotting
-    plots = ChronoPlots(inPath, outDir)
+    plots = ChronoPlots(inPath, outDir, weights=weights, storeDir=storeDir,
+                        weightTableBins=weightTableBins)
     if verbose:
         print("Using data in {}".format(inPath))
         print("Saving plots to {}".format(outDir))
+    # Declare every histogram up front so that they are filled in one pass
+    for i in range(0, 3):
+        plots.BookLayerEtaEff(i)
+        plots.BookLayerEtaEff(i, highEta=True)
+    plots.Fill()
     # Plot layer hits
     for i in range(0, 4):
         # if verbose: print("Plotting layer {}".format(i))
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+# Curvature constant: 1/R [1/m] = C * q [e] * B [T] / pt [GeV]
+C = 0.299792458
+
+def Propagate(rays, layerZ, bField=0.):
+    """ Return (nRays, nLayers, 3) positions where each ray (structured array)
+        crosses the plane z = layerZ[j] of each layer, following a helix in a
+        solenoid field of bField Tesla along z (straight line if 0). Positions
+        are NaN for rays that never reach a layer.
+    """
+    pos = np.asarray(rays["pos"], dtype=float).reshape(-1, 1, 3)
+    p = np.asarray(rays["p"], dtype=float).reshape(-1, 1, 3)
+    charge = np.asarray(rays["charge"], dtype=float).reshape(-1, 1)
+    layerZ = np.asarray(layerZ, dtype=float).reshape(1, -1)
+    pt = np.hypot(p[..., 0], p[..., 1])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # Path parameter to each layer plane, in units of p, and transverse path length
+        t = (layerZ-pos[..., 2])/p[..., 2]
+        t[~(t >= 0)] = np.nan
+        s = pt*t
+        # Unit transverse direction and signed curvature (> 0 counterclockwise)
+        isMoving = (pt > 0)
+        ux = np.where(isMoving, p[..., 0]/pt, 0.)
+        uy = np.where(isMoving, p[..., 1]/pt, 0.)
+        omega = np.where(isMoving, -C*charge*bField/pt, 0.)
+        isCurved = (omega != 0)
+        phase = omega*s
+        sinTerm = np.where(isCurved, np.sin(phase)/omega, s)
+        cosTerm = np.where(isCurved, (1-np.cos(phase))/omega, 0.)
+
+    layerPos = np.empty(t.shape+(3,))
+    layerPos[..., 0] = pos[..., 0] + ux*sinTerm - uy*cosTerm
+    layerPos[..., 1] = pos[..., 1] + uy*sinTerm + ux*cosTerm
+    layerPos[..., 2] = np.where(np.isnan(t), np.nan, layerZ)
+
+    return layerPos
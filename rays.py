@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+from itertools import islice
+
+# One row per ray, same column order as the trajectory txt files
+RAY_DTYPE = np.dtype([ ("id",     np.float64),
+                       ("mass",   np.float64),
+                       ("charge", np.float64),
+                       ("pt",     np.float64),
+                       ("eta",    np.float64),
+                       ("phi",    np.float64),
+                       ("pos",    np.float64, (3,)),
+                       ("p",      np.float64, (3,)) ])
+# Rays with an importance weight, e.g. when oversampling part of the rays
+WEIGHTED_RAY_DTYPE = np.dtype(RAY_DTYPE.descr+[ ("weight", np.float64) ])
+
+def ParseRays(lines):
+    """ Parse lines of ray trajectory data into a structured array """
+    values = np.array(" ".join(lines).split(), dtype=np.float64)
+    return values.reshape(-1, 12).view(RAY_DTYPE).reshape(-1)
+
+def IterRays(rayPath, chunkSize=100000):
+    """ Iterate over ray trajectory data from txt file in chunks of at most
+        chunkSize rays
+    """
+    with open(rayPath, "r") as rayFile:
+        while True:
+            lines = list(islice(rayFile, chunkSize))
+            if not lines: break
+            yield ParseRays(lines)
+
+def LoadRays(rayPath, verbose=False):
+    """ Load ray trajectory data from txt file into a structured array """
+    rays = np.concatenate([ np.zeros(0, dtype=RAY_DTYPE) ]+list(IterRays(rayPath)))
+    if verbose:
+        print("Loaded {0} trajectories from file {1}".format(len(rays), rayPath))
+
+    return rays
+
+def IterBlocks(rays, blockSize):
+    """ Split a structured array, or an iterable of them, into blocks of at
+        most blockSize rays
+    """
+    chunks = [rays] if isinstance(rays, np.ndarray) else rays
+    for chunk in chunks:
+        for start in range(0, len(chunk), blockSize):
+            yield chunk[start:start+blockSize]
+
+def AddWeights(rays, weights):
+    """ Return copy of rays with a per-ray importance weight field """
+    weighted = np.zeros(len(rays), dtype=WEIGHTED_RAY_DTYPE)
+    for name in RAY_DTYPE.names:
+        weighted[name] = rays[name]
+    weighted["weight"] = weights
+    return weighted
@@ -0,0 +1,36 @@
+import numpy as np
+
+def AsArray(buf, n, dtype=np.float64):
+    """ Return numpy view of the first n entries of a PyROOT buffer """
+    if hasattr(buf, "reshape"):
+        buf.reshape((n,))
+    else:
+        buf.SetSize(n)
+    return np.frombuffer(buf, dtype=dtype, count=n)
+
+def GetBins(values, binning):
+    """ Return ROOT global bin (0 underflow, nBins+1 overflow) of a list of
+        one or two arrays of values for a (1D or 2D) binning, -1 if NaN
+    """
+    globalBin = np.zeros(len(values[0]), dtype=int)
+    isValid = np.ones(len(values[0]), dtype=bool)
+    stride = 1
+    for k, vals in enumerate(values):
+        nBins, low, high = binning[3*k:3*k+3]
+        edges = np.linspace(low, high, nBins+1)
+        isValid &= ~np.isnan(vals)
+        globalBin += stride*np.searchsorted(edges, vals, side="right")
+        stride *= nBins+2
+    globalBin[~isValid] = -1
+    return globalBin
+
+def GetNCells(binning):
+    """ Return number of ROOT cells (including under/overflow) of a binning """
+    return int(np.prod([ nBins+2 for nBins in binning[::3] ]))
+
+def GetBinning(hist, nDims):
+    """ Return (nBins, low, high) binning of each of the first nDims axes of a histogram """
+    binning = ()
+    for axis in [hist.GetXaxis(), hist.GetYaxis()][:nDims]:
+        binning += (axis.GetNbins(), axis.GetXmin(), axis.GetXmax())
+    return binning
@@ -0,0 +1,47 @@
+import numpy as np
+
+class WeightTable:
+    def __init__(self, edges, values):
+        """ Binned lookup table of weights, where values[i] is the weight of
+            [edges[i], edges[i+1])
+        """
+        self.edges = np.asarray(edges, dtype=float)
+        self.values = np.asarray(values, dtype=float)
+
+    @classmethod
+    def FromFile(cls, path):
+        """ Load table from txt file with one "low high weight" line per bin """
+        table = np.loadtxt(path, ndmin=2)
+        return cls(np.append(table[:, 0], table[-1, 1]), table[:, 2])
+
+    @classmethod
+    def FromFunction(cls, func, nBins=2000, low=-5., high=5.):
+        """ Build table by evaluating func at the center of each bin """
+        edges = np.linspace(low, high, nBins+1)
+        centers = 0.5*(edges[1:]+edges[:-1])
+        return cls(edges, [ func(center) for center in centers ])
+
+    def Write(self, path):
+        """ Write table to txt file readable by FromFile """
+        np.savetxt(path, np.column_stack((self.edges[:-1], self.edges[1:], self.values)))
+        return
+
+    def __call__(self, x):
+        """ Return weights of an array of values, using the first/last bin
+            for values outside of the table
+        """
+        index = np.searchsorted(self.edges, x, side="right")-1
+        return self.values[np.clip(index, 0, len(self.values)-1)]
+
+class WeightFunction:
+    def __init__(self, func):
+        """ Exact per-value weights of a scalar function, evaluated once per
+            distinct value
+        """
+        self.func = func
+
+    def __call__(self, x):
+        """ Return weights of an array of values """
+        values, inverse = np.unique(np.asarray(x, dtype=float), return_inverse=True)
+        weights = np.array([ self.func(value) for value in values ], dtype=float)
+        return weights[inverse.reshape(-1)].reshape(np.shape(x))